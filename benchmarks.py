@@ -0,0 +1,247 @@
+"""CSC111 Winter 2023 Course Project
+
+===============================
+This Python module contains micro-benchmarks for the performance sensitive parts of the project.
+
+Copyright and Usage Information
+===============================
+All forms of distribution of this code, whether as given or with any changes, are
+expressly prohibited.
+
+This file is Copyright (c) 2023 Nicolas Dias Martins, Sana-E-Zehra Mehdi, Rohan Patra, and Maleeha Rahman.
+"""
+import array
+import csv
+import math
+import random
+import timeit
+import tracemalloc
+from typing import Any, Callable, Optional
+
+import data_security as cp
+from database import HealthNetwork, Medical, Office, Patient
+from patient_intake import ApplicationTree
+
+# A patient record, as returned by Patient.to_list
+SAMPLE_RECORD = ['jdoe1234', 'Jane', 'Doe', 'CA', '(4, 12, 1998)', 'Female', 'Woman', '165.0', '165.0', '60.0',
+                 'English', 'jane.doe@gmail.com', '4165550123', 'None']
+
+
+def sample_keys(p: int = 1009, q: int = 1013) -> tuple[tuple[int, int, int], tuple[int, int]]:
+    """Return a (private key, public key) pair built from the given primes, using the usual public
+    exponent 65537 when possible.
+    """
+    n = p * q
+    phi = (p - 1) * (q - 1)
+    e = 65537
+    while math.gcd(e, phi) != 1:
+        e = random.randint(2, phi - 1)
+    d = pow(e, -1, phi)
+
+    return ((p, q, d), (n, e))
+
+
+def naive_encrypt_record(record: list[str], public_key: tuple[int, int]) -> list[str]:
+    """Encrypt record the way file_encrypt_str used to: exponentiate, then reduce, and concatenate strings.
+    """
+    n, e = public_key
+    encrypted = []
+    for field in record:
+        encrypted_text = ''
+        for char in field:
+            encrypted_text = encrypted_text + chr((ord(char) ** e) % n)
+        encrypted.append(encrypted_text)
+
+    return encrypted
+
+
+def benchmark_record_encryption(repeat: int = 3) -> dict[str, float]:
+    """Return the best time in seconds to encrypt SAMPLE_RECORD before and after the modular exponentiation
+    rework.
+    """
+    _, public_key = sample_keys()
+    before = min(timeit.repeat(lambda: naive_encrypt_record(SAMPLE_RECORD, public_key), number=1, repeat=repeat))
+    after = min(timeit.repeat(lambda: cp.encrypt_record(SAMPLE_RECORD, public_key), number=1, repeat=repeat))
+
+    return {'before': before, 'after': after}
+
+
+def benchmark_crt_decryption(number: int = 200) -> dict[str, float]:
+    """Return the average time in seconds to decrypt one block with a large key, using a full-size
+    exponentiation modulo p * q and using a precomputed CRT private key.
+    The two Mersenne primes 2 ** 521 - 1 and 2 ** 607 - 1 give a modulus of over a thousand bits.
+    """
+    private_key, public_key = sample_keys(2 ** 521 - 1, 2 ** 607 - 1)
+    p, q, d = private_key
+    n, e = public_key
+    block = pow(123456789, e, n)
+    crt_key = cp.PrivateKey(p, q, d)
+    before = timeit.timeit(lambda: pow(block, d, n), number=number) / number
+    after = timeit.timeit(lambda: crt_key.decrypt_int(block), number=number) / number
+
+    return {'before': before, 'after': after}
+
+
+def benchmark_encryption_modes(field_length: int, number: int = 20) -> dict[str, float]:
+    """Return the average time in seconds to encrypt a record of SAMPLE_RECORD's size whose fields are all
+    field_length characters long, in 'block' and 'hybrid' mode, with a key of over a thousand bits.
+    """
+    _, public_key = sample_keys(2 ** 521 - 1, 2 ** 607 - 1)
+    record = ['x' * field_length] * len(SAMPLE_RECORD)
+
+    return {mode: timeit.timeit(lambda: cp.encrypt_record(record, public_key, mode), number=number) / number
+            for mode in ['block', 'hybrid']}
+
+
+class DictMedical:
+    """A doctor laid out the way Medical was before it was given __slots__ and its categorical attributes were
+    encoded in CATEGORIES: every attribute is kept in the instance dictionary, with its own strings.
+    """
+    profession: bool
+    first_name: str
+    last_name: str
+    state: str
+    degree: str
+    gender: str
+    phone_number: int
+    email: str
+    current_patients: list[Patient]
+    specialization: str
+    user: str
+    passw: str
+
+    def __init__(self, profession: str, first_name: str, last_name: str, state: str, degree: str,
+                 gender: str, email: str, specialization: str, phone_number: int, user: str, passw: str) -> None:
+        """Initialize a new doctor, as Medical does.
+        """
+        self.profession = profession == 'Psychologist'
+        self.first_name = first_name
+        self.last_name = last_name
+        self.state = state
+        self.degree = degree
+        self.gender = gender
+        self.phone_number = phone_number
+        self.email = email
+        self.current_patients = []
+        self.specialization = specialization
+        self.user = user
+        self.passw = passw
+
+
+class UnpackedPatient(Patient):
+    """A patient that keeps its encrypted data as a list holding a separate str or bytes object per item, the way
+    Patient did before it packed it.
+    check_contracts evaluates the annotations of the methods inherited from Patient in this module, which is why
+    Optional and Office are imported here, and checks the packed attributes of Patient on every instance, which is
+    why they are given empty values shared by the class.
+    """
+    current: Optional[Office]
+    unpacked_data: list[str | bytes]
+    _encrypted_blob = ''
+    _encrypted_ends = array.array('I')
+
+    @property
+    def encrypted_data(self) -> list[str | bytes]:
+        """Return the encrypted data of this patient.
+        """
+        return self.unpacked_data
+
+    @encrypted_data.setter
+    def encrypted_data(self, value: list[str | bytes]) -> None:
+        """Set the encrypted data of this patient.
+        """
+        self.unpacked_data = value
+
+
+def allocated_per_object(make: Callable[[int], Any], n: int) -> float:
+    """Return the average number of bytes still allocated after creating the n objects make(0), ..., make(n - 1).
+    """
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    objects = [make(i) for i in range(n)]
+    allocated = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del objects
+
+    return allocated / n
+
+
+def benchmark_memory(n: int = 10000) -> dict[str, dict[str, float]]:
+    """Return the number of bytes allocated per doctor and per patient for n of them, before and after their
+    compact layouts: doctors (with their strings) read from csv rows as DictMedical and as Medical, and patients
+    (with their strings and encrypted data, but not their keys) as UnpackedPatient and as Patient.
+    """
+    def doctor_row(i: int) -> list[str]:
+        """Return the csv row of doctor i, parsed as read_network parses the rows of the dataset.
+        """
+        return next(csv.reader([f'Psychologist,First{i},Last{i},CA,PhD,Woman,first{i}last{i}@gmail.com,Anxiety,'
+                                f'{4165550000 + i},first{i}last{i},password']))
+
+    def doctor(cls: type, i: int) -> Any:
+        """Return doctor i as an instance of cls.
+        """
+        row = doctor_row(i)
+        return cls(*row[:8], int(row[8]), *row[9:])
+
+    keys = (cp.PrivateKey(61, 53, 2753), (3233, 17))
+
+    def patient(cls: type, i: int) -> Patient:
+        """Return patient i as an instance of cls.
+        """
+        return cls(f'First{i}', f'Last{i}', 'CA', (4, 12, 1998), 'Female', 'Woman', 165.0, 60.0, 'English',
+                   f'first{i}last{i}@gmail.com', 4165550000 + i, [f'medication{i}'], [f'allergy{i}'],
+                   f'first{i}last{i}', 'password', None, None, keys)
+
+    return {'doctor': {'before': allocated_per_object(lambda i: doctor(DictMedical, i), n),
+                       'after': allocated_per_object(lambda i: doctor(Medical, i), n)},
+            'patient': {'before': allocated_per_object(lambda i: patient(UnpackedPatient, i), n),
+                        'after': allocated_per_object(lambda i: patient(Patient, i), n)}}
+
+
+def sample_network(n: int) -> HealthNetwork:
+    """Return a network of n doctors with random professions, specializations, states, degrees and genders.
+    """
+    rng = random.Random(111)
+    network = HealthNetwork(fully_connected=True)
+
+    for i in range(n):
+        network.add_office(Medical(rng.choice(['Psychologist', 'Counselor']), f'First{i}', f'Last{i}',
+                                   rng.choice(['CA', 'FL', 'NY', 'TX', 'WA', 'ON', 'IL', 'MA']),
+                                   rng.choice(['PhD', 'PsyD', 'MA', 'MSW']), rng.choice(['M', 'F']),
+                                   f'first{i}last{i}@gmail.com',
+                                   rng.choice(['Clinical', 'Counseling', 'School', 'Addiction', 'Marriage']),
+                                   4165550000 + i, f'first{i}last{i}', 'password'))
+
+    return network
+
+
+def benchmark_doctor_filtering(n: int, number: int = 5) -> dict[str, float]:
+    """Return the average time in seconds to find the doctors matching a classification, specialization and state
+    among n doctors: with an ApplicationTree and with the doctor index.
+    """
+    network = sample_network(n)
+    preferences = [['Classification', 'Psychologist'], ['Specialization', 'Clinical'], ['State', 'CA']]
+
+    def tree_search() -> None:
+        """Filter the doctors of network through an application tree.
+        """
+        ApplicationTree(network=network).insert_possible_choice(preferences)
+
+    return {'tree': timeit.timeit(tree_search, number=number) / number,
+            'index': timeit.timeit(lambda: network.doctor_index.search(preferences), number=number) / number}
+
+
+if __name__ == '__main__':
+    for name, seconds in benchmark_record_encryption().items():
+        print(f'record encryption ({name}): {seconds * 1000:.3f} ms per record')
+    for name, seconds in benchmark_crt_decryption().items():
+        print(f'large key decryption ({name}): {seconds * 1000:.3f} ms per block')
+    for length in [10, 100, 1000]:
+        for name, seconds in benchmark_encryption_modes(length).items():
+            print(f'{length} character fields ({name}): {seconds * 1000:.3f} ms per record')
+    for name, sizes in benchmark_memory().items():
+        for layout, size in sizes.items():
+            print(f'memory ({layout}): {size:.0f} bytes per {name}')
+    for size in [10000, 100000, 1000000]:
+        for name, seconds in benchmark_doctor_filtering(size).items():
+            print(f'filtering {size} doctors ({name}): {seconds * 1000:.3f} ms per search')
@@ -7,9 +7,22 @@ All forms of distribution of this code, whether as given or with any changes, ar
 expressly prohibited.
 This file is Copyright (c) 2023 Nicolas Dias Martins, Sana-E-Zehra Mehdi, Rohan Patra, and Maleeha Rahman.
 """
+from __future__ import annotations
+
 import csv
+import hashlib
+import hmac
+import mmap
+import os
+import queue
 import random
 import math
+import secrets
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterator, Optional, Sequence
 
 
 def read_csv(primes_list: str) -> list[int]:
@@ -26,25 +39,98 @@ def read_csv(primes_list: str) -> list[int]:
     return primes
 
 
+class PrimesTable:
+    """The primes listed in a primes csv file, stored in a binary file next to it and memory-mapped.
+    The binary file holds every prime as an unsigned 64-bit integer and is rebuilt whenever the csv file is newer.
+    If the primes cannot be stored this way, they are kept in a list instead.
+    Instance Attributes:
+        - primes_list: The csv file the primes were read from
+        - primes: The primes, in the order they are listed in primes_list
+    Representation Invariants:
+        - len(self.primes) >= 2
+    """
+    primes_list: str
+    primes: Sequence[int]
+
+    def __init__(self, primes_list: str) -> None:
+        """Initialize the table of the primes in primes_list, building its binary file if needed.
+        Preconditions:
+            - primes_list refers to a csv file in the format described on the project report
+            - primes_list lists at least two primes
+        """
+        self.primes_list = primes_list
+        binary_file = os.path.splitext(primes_list)[0] + '.bin'
+
+        try:
+            if not os.path.exists(binary_file) or os.path.getmtime(binary_file) < os.path.getmtime(primes_list):
+                build_primes_file(primes_list, binary_file)
+            with open(binary_file, 'rb') as file:
+                self.primes = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)).cast('Q')
+        except (OSError, OverflowError, ValueError):
+            self.primes = read_csv(primes_list)
+
+    def sample_pair(self) -> tuple[int, int]:
+        """Return two primes at random, from two different positions of the table.
+        """
+        first = random.randrange(len(self.primes))
+        second = random.randrange(len(self.primes) - 1)
+        if second >= first:
+            second += 1
+
+        return (self.primes[first], self.primes[second])
+
+
+def build_primes_file(primes_list: str, binary_file: str) -> None:
+    """Write the primes in primes_list to binary_file as unsigned 64-bit integers.
+    Raise an OverflowError if a prime does not fit in 64 bits.
+    """
+    primes = array('Q', read_csv(primes_list))
+    temporary_file = binary_file + '.tmp'
+
+    with open(temporary_file, 'wb') as file:
+        primes.tofile(file)
+    os.replace(temporary_file, binary_file)
+
+
+# The primes table of each primes file, loaded once by load_primes
+_PRIMES_TABLES: dict[str, PrimesTable] = {}
+_PRIMES_LOCK = threading.Lock()
+
+
+def load_primes(primes_list: str) -> PrimesTable:
+    """Return the table of the primes in primes_list, loading it the first time it is requested.
+    """
+    with _PRIMES_LOCK:
+        if primes_list not in _PRIMES_TABLES:
+            _PRIMES_TABLES[primes_list] = PrimesTable(primes_list)
+
+        return _PRIMES_TABLES[primes_list]
+
+
 def select_primes(primes_list: str) -> tuple[int, int]:
     """Return a tuple of ints based on a list created from prime_list.
     Preconditions:
         - primes_list refers to a csv file in the format described on the project report
     """
-    primes = read_csv(primes_list)
-    first_prime = random.choice(primes)
-    primes.remove(first_prime)
-    second_prime = random.choice(primes)
-
-    return (first_prime, second_prime)
+    return load_primes(primes_list).sample_pair()
 
 
-def generate_keys(primes_list: str) -> tuple[tuple[int, int, int], tuple[int, int]]:
+def generate_keys(primes_list: str, key_size: Optional[int] = None) -> tuple[PrivateKey, tuple[int, int]]:
     """Return a generated pair of a public and a private key.
-    This function returns a tuple of the format (public key, private key).
+    This function returns a tuple of the format (private key, public key).
+    If key_size is given, the key is made of two primes generated by the prime generation engine so that the
+    modulus has key_size bits, and primes_list is not used. The key is taken from the key cache of key_size if
+    start_key_cache was called for it.
     Preconditions:
         - isinstance(primes_list, str)
+        - key_size is None or key_size >= 32
     """
+    if key_size is not None:
+        if key_size in _KEY_CACHES:
+            return _KEY_CACHES[key_size].take_keys()
+        else:
+            return generate_large_keys(key_size)
+
     primes = select_primes(primes_list)
     p, q = primes
 
@@ -55,17 +141,296 @@ def generate_keys(primes_list: str) -> tuple[tuple[int, int, int], tuple[int, in
     while math.gcd(e, phi) != 1:
         e = random.randint(2, phi - 1)
 
-    d = random.randint(2, phi - 1)
-    while ((d * e) - 1) % phi != 0:
-        d = random.randint(2, phi - 1)
+    d = modular_inverse(e, phi)
+
+    return (PrivateKey(p, q, d), (n, e))
+
+
+def modular_inverse(a: int, m: int) -> int:
+    """Return the inverse of a modulo m, found with the extended Euclidean algorithm.
+    Preconditions:
+        - m > 1
+        - math.gcd(a, m) == 1
+
+    >>> modular_inverse(3, 11)
+    4
+    >>> (modular_inverse(17, 3120) * 17) % 3120
+    1
+    """
+    old_r, r = a % m, m
+    old_s, s = 1, 0
+
+    while r != 0:
+        quotient = old_r // r
+        old_r, r = r, old_r - quotient * r
+        old_s, s = s, old_s - quotient * s
+
+    return old_s % m
+
+
+class PrivateKey:
+    """A private key, along with the values needed to decrypt with the Chinese remainder theorem.
+    Iterating over a private key gives (p, q, d), so it can be used wherever a (p, q, d) tuple is expected.
+    Instance Attributes:
+        - p: The first prime of the key
+        - q: The second prime of the key
+        - d: The private exponent
+        - dp: d reduced modulo p - 1
+        - dq: d reduced modulo q - 1
+        - q_inv: The inverse of q modulo p
+    Representation Invariants:
+        - self.p != self.q
+        - (self.q * self.q_inv) % self.p == 1
+    """
+    p: int
+    q: int
+    d: int
+    dp: int
+    dq: int
+    q_inv: int
+
+    def __init__(self, p: int, q: int, d: int) -> None:
+        """Initialize the private key (p, q, d) and precompute its CRT values.
+        Preconditions:
+            - p != q
+        """
+        self.p = p
+        self.q = q
+        self.d = d
+        self.dp = d % (p - 1)
+        self.dq = d % (q - 1)
+        self.q_inv = modular_inverse(q, p)
+
+    def __iter__(self) -> Iterator[int]:
+        """Return an iterator over (p, q, d).
+        """
+        return iter((self.p, self.q, self.d))
+
+    def decrypt_int(self, c: int) -> int:
+        """Return c ** d modulo p * q, computed with one exponentiation modulo p and one modulo q.
+        Preconditions:
+            - 0 <= c < self.p * self.q
+
+        >>> key = PrivateKey(61, 53, 2753)
+        >>> key.decrypt_int(2790) == pow(2790, 2753, 61 * 53)
+        True
+        """
+        m1 = pow(c, self.dp, self.p)
+        m2 = pow(c, self.dq, self.q)
+        h = (self.q_inv * (m1 - m2)) % self.p
+
+        return m2 + h * self.q
+
+
+def as_private_key(private_key: PrivateKey | tuple[int, int, int]) -> PrivateKey:
+    """Return private_key as a PrivateKey.
+    """
+    if isinstance(private_key, PrivateKey):
+        return private_key
+    else:
+        p, q, d = private_key
+        return PrivateKey(p, q, d)
+
+
+class KeyPool:
+    """A pool of key pairs that a worker thread generates ahead of time.
+    Instance Attributes:
+        - primes_list: The csv file that the primes of the keys are selected from
+        - keys: The key pairs that are ready to be used, in the format returned by generate_keys
+        - worker: The daemon thread that keeps self.keys full
+    """
+    primes_list: str
+    keys: queue.Queue
+    worker: threading.Thread
+
+    def __init__(self, primes_list: str, size: int = 32) -> None:
+        """Initialize a pool of at most size key pairs and start filling it in the background.
+        Preconditions:
+            - size > 0
+        """
+        self.primes_list = primes_list
+        self.keys = queue.Queue(maxsize=size)
+        self.worker = threading.Thread(target=self._fill, daemon=True)
+        self.worker.start()
+
+    def _fill(self) -> None:
+        """Generate key pairs forever, waiting whenever the pool is full.
+        """
+        while True:
+            self.keys.put(generate_keys(self.primes_list))
+
+    def take_keys(self) -> tuple[PrivateKey, tuple[int, int]]:
+        """Return a ready key pair, or generate one right away if the pool is empty.
+        """
+        try:
+            return self.keys.get_nowait()
+        except queue.Empty:
+            return generate_keys(self.primes_list)
+
+
+# The key pool of each primes file, created by start_key_pool
+_KEY_POOLS: dict[str, KeyPool] = {}
+
+
+def start_key_pool(primes_list: str, size: int = 32) -> None:
+    """Start generating key pairs from primes_list in the background, if it is not already being done.
+    """
+    if primes_list not in _KEY_POOLS:
+        _KEY_POOLS[primes_list] = KeyPool(primes_list, size)
+
+
+def take_keys(primes_list: str, key_size: Optional[int] = None) -> tuple[PrivateKey, tuple[int, int]]:
+    """Return a key pair made from primes_list, or of key_size bits if it is given, in the format returned by
+    generate_keys.
+    The key pair is taken from the key pool of primes_list if start_key_pool was called for it.
+    """
+    if key_size is not None:
+        return generate_keys(primes_list, key_size)
+    elif primes_list in _KEY_POOLS:
+        return _KEY_POOLS[primes_list].take_keys()
+    else:
+        return generate_keys(primes_list)
+
+
+# The primes below 40, used to rule out most composite numbers before running Miller-Rabin
+SMALL_PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37]
+
+
+def is_probable_prime(n: int, rounds: int = 40) -> bool:
+    """Return whether n is prime, using the Miller-Rabin test with the given number of random bases.
+    A composite number is reported as prime with probability at most 4 ** -rounds.
+
+    >>> is_probable_prime(2 ** 127 - 1)
+    True
+    >>> is_probable_prime(561)
+    False
+    """
+    if n < 2:
+        return False
+    for prime in SMALL_PRIMES:
+        if n % prime == 0:
+            return n == prime
+
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+
+    for _ in range(rounds):
+        x = pow(random.randrange(2, n - 1), d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(r - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+
+    return True
+
+
+def generate_prime(bits: int) -> int:
+    """Return a random prime of exactly the given number of bits whose two highest bits are set, so that the
+    product of two such primes has exactly 2 * bits bits.
+    Preconditions:
+        - bits >= 16
+    """
+    while True:
+        candidate = secrets.randbits(bits) | (3 << (bits - 2)) | 1
+        if is_probable_prime(candidate):
+            return candidate
+
+
+def generate_large_keys(key_size: int) -> tuple[PrivateKey, tuple[int, int]]:
+    """Return a generated pair of a private and a public key whose modulus has key_size bits, in the format
+    returned by generate_keys.
+    The public exponent is 65537.
+    Preconditions:
+        - key_size >= 32
+        - key_size % 2 == 0
+    """
+    e = 65537
+
+    while True:
+        p = generate_prime(key_size // 2)
+        q = generate_prime(key_size // 2)
+        phi = (p - 1) * (q - 1)
+        if p != q and math.gcd(e, phi) == 1:
+            return (PrivateKey(p, q, modular_inverse(e, phi)), (p * q, e))
+
+
+class LargeKeyCache:
+    """A cache of key pairs of a given size that a pool of worker processes generates in parallel.
+    Instance Attributes:
+        - key_size: The number of bits of the modulus of the keys
+        - executor: The worker processes generating the keys
+        - pending: The key pairs being generated (or already generated), oldest first
+    Representation Invariants:
+        - len(self.pending) > 0
+    """
+    key_size: int
+    executor: ProcessPoolExecutor
+    pending: deque[Future]
+    _lock: threading.Lock
+
+    def __init__(self, key_size: int, size: Optional[int] = None, max_workers: Optional[int] = None) -> None:
+        """Initialize a cache holding size key pairs of key_size bits, and start generating them with at most
+        max_workers processes. Both default to the number of CPUs.
+        Preconditions:
+            - key_size >= 32
+            - key_size % 2 == 0
+            - size is None or size > 0
+        """
+        self.key_size = key_size
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        if size is None:
+            size = os.cpu_count() or 1
+        self.pending = deque(self.executor.submit(generate_large_keys, key_size) for _ in range(size))
+
+    def take_keys(self) -> tuple[PrivateKey, tuple[int, int]]:
+        """Return a generated key pair and start generating one to replace it.
+        A key pair that is already done is returned if there is one. Otherwise, wait for the oldest one.
+        """
+        with self._lock:
+            future = next((future for future in self.pending if future.done()), self.pending[0])
+            self.pending.remove(future)
+            self.pending.append(self.executor.submit(generate_large_keys, self.key_size))
+
+        return future.result()
+
+    def shutdown(self) -> None:
+        """Stop the worker processes, without waiting for the pending key pairs.
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# The key cache of each key size, created by start_key_cache
+_KEY_CACHES: dict[int, LargeKeyCache] = {}
+
+
+def start_key_cache(key_size: int, size: Optional[int] = None) -> None:
+    """Start generating key pairs of key_size bits in parallel worker processes, if it is not already being done.
+    """
+    if not _KEY_CACHES:
+        # Unlike atexit, these exit hooks run before the one concurrent.futures joins its worker processes in, so
+        # the key pairs still waiting in the caches are cancelled instead of generated.
+        threading._register_atexit(shutdown_key_caches)
+    if key_size not in _KEY_CACHES:
+        _KEY_CACHES[key_size] = LargeKeyCache(key_size, size)
 
-    assert verify_key((p, q, d), (n, e))
 
-    return ((p, q, d), (n, e))
+def shutdown_key_caches() -> None:
+    """Stop the worker processes of every key cache, without waiting for their pending key pairs.
+    This is called when the program exits.
+    """
+    for cache in _KEY_CACHES.values():
+        cache.shutdown()
 
 
-def verify_key(private_key: tuple[int, int, int], public_key: tuple[int, int]) -> bool:
-    """Helper function for generate_private_key."""
+def verify_key(private_key: PrivateKey | tuple[int, int, int], public_key: tuple[int, int]) -> bool:
+    """Return whether the given keys are a matching pair by encrypting and decrypting a test message."""
     n, e = public_key
     p, q, d = private_key
 
@@ -87,27 +452,251 @@ def file_encrypt_str(plaintext: str, public_key: tuple[int, int]) -> str:
         - len(plaintext) > 0
     """
     n, e = public_key
-    encrypted_text = ''
 
-    for char in plaintext:
-        encrypted_text = encrypted_text + chr((ord(char) ** e) % n)
+    return ''.join([chr(pow(ord(char), e, n)) for char in plaintext])
 
-    return encrypted_text
 
-
-def file_decrypt_str(cyphertext: str, private_key: tuple[int, int, int]) -> str:
+def file_decrypt_str(cyphertext: str, private_key: PrivateKey | tuple[int, int, int]) -> str:
     """Decrypt the given cyphertext by using the private key.
     Preconditions:
         - len(cyphertext) > 0
     """
-    p, q, d = private_key
-    n = p * q
-    decrypted_text = ''
+    decrypt_int = as_private_key(private_key).decrypt_int
+
+    return ''.join([chr(decrypt_int(ord(char))) for char in cyphertext])
+
+
+def block_sizes(n: int) -> tuple[int, int]:
+    """Return the number of plaintext bytes that fit in one block under the modulus n, and the number of bytes
+    needed to store one encrypted block.
+    Raise a ValueError if n is too small for a block to hold a whole byte, that is if n <= 256.
+
+    >>> block_sizes(61 * 53)
+    (1, 2)
+    >>> block_sizes(13 * 17)
+    Traceback (most recent call last):
+    ...
+    ValueError: A modulus of 221 is too small to encrypt whole bytes; it must be over 256
+    """
+    if n <= 256:
+        raise ValueError(f'A modulus of {n} is too small to encrypt whole bytes; it must be over 256')
+
+    return ((n.bit_length() - 1) // 8, (n.bit_length() + 7) // 8)
+
+
+def file_encrypt_bytes(plaintext: str, public_key: tuple[int, int]) -> bytes:
+    """Encrypt the given plaintext by using the public key, packing as many bytes of its UTF-8 encoding as fit
+    under the modulus into each encrypted block (see encrypt_bytes).
+    Preconditions:
+        - public_key[0] > 256
+    """
+    return encrypt_bytes(plaintext.encode(), public_key)
+
+
+def file_decrypt_bytes(cyphertext: bytes, private_key: PrivateKey | tuple[int, int, int]) -> str:
+    """Decrypt the given cyphertext, produced by file_encrypt_bytes, by using the private key.
+    """
+    return decrypt_bytes(cyphertext, private_key).decode()
+
+
+def encrypt_bytes(data: bytes, public_key: tuple[int, int]) -> bytes:
+    """Encrypt data by using the public key, packing as many bytes as fit under the modulus into each block.
+    The result starts with the length of data (4 bytes), followed by the encrypted blocks.
+    Preconditions:
+        - public_key[0] > 256
+    """
+    n, e = public_key
+    plain_size, cypher_size = block_sizes(n)
+    padded = data + bytes(-len(data) % plain_size)
+
+    blocks = [pow(int.from_bytes(padded[i:i + plain_size], 'big'), e, n).to_bytes(cypher_size, 'big')
+              for i in range(0, len(padded), plain_size)]
+
+    return len(data).to_bytes(4, 'big') + b''.join(blocks)
+
+
+def decrypt_bytes(cyphertext: bytes, private_key: PrivateKey | tuple[int, int, int]) -> bytes:
+    """Decrypt the given cyphertext, produced by encrypt_bytes, by using the private key.
+    """
+    private_key = as_private_key(private_key)
+    decrypt_int = private_key.decrypt_int
+    plain_size, cypher_size = block_sizes(private_key.p * private_key.q)
+    length = int.from_bytes(cyphertext[:4], 'big')
+
+    blocks = [decrypt_int(int.from_bytes(cyphertext[i:i + cypher_size], 'big')).to_bytes(plain_size, 'big')
+              for i in range(4, len(cyphertext), cypher_size)]
+
+    return b''.join(blocks)[:length]
+
+
+# The number of bytes of a session key and of the tag added to every symmetrically encrypted field
+SESSION_KEY_SIZE = 16
+TAG_SIZE = 16
+
+# The number of bytes of a SHA-256 digest, used by the OAEP padding of wrapped session keys, and the smallest
+# number of bits of a modulus that a padded session key fits under
+HASH_SIZE = 32
+MIN_HYBRID_KEY_SIZE = 8 * (2 * HASH_SIZE + 2 + SESSION_KEY_SIZE)
+
+
+def mask(seed: bytes, length: int) -> bytes:
+    """Return a mask of length bytes generated from seed with MGF1 over SHA-256.
+    """
+    blocks = [hashlib.sha256(seed + counter.to_bytes(4, 'big')).digest()
+              for counter in range(-(-length // HASH_SIZE))]
+
+    return b''.join(blocks)[:length]
+
+
+def oaep_pad(message: bytes, size: int) -> bytes:
+    """Return message padded into size bytes with OAEP (SHA-256, MGF1 and an empty label), using a new random
+    seed every time.
+    Preconditions:
+        - len(message) <= size - 2 * HASH_SIZE - 2
+    """
+    data = hashlib.sha256(b'').digest() + bytes(size - len(message) - 2 * HASH_SIZE - 2) + b'\x01' + message
+    seed = secrets.token_bytes(HASH_SIZE)
+    masked_data = bytes(a ^ b for a, b in zip(data, mask(seed, len(data))))
+    masked_seed = bytes(a ^ b for a, b in zip(seed, mask(masked_data, HASH_SIZE)))
+
+    return b'\x00' + masked_seed + masked_data
+
+
+def oaep_unpad(padded: bytes) -> bytes:
+    """Return the message that oaep_pad padded into padded.
+    Raise a ValueError if padded is not a valid padding.
+
+    >>> oaep_unpad(oaep_pad(b'session key', 100))
+    b'session key'
+    """
+    masked_seed, masked_data = padded[1:1 + HASH_SIZE], padded[1 + HASH_SIZE:]
+    seed = bytes(a ^ b for a, b in zip(masked_seed, mask(masked_data, HASH_SIZE)))
+    data = bytes(a ^ b for a, b in zip(masked_data, mask(seed, len(masked_data))))
+    separator = data.find(b'\x01', HASH_SIZE)
+
+    if (padded[0] != 0 or not hmac.compare_digest(data[:HASH_SIZE], hashlib.sha256(b'').digest())
+            or separator == -1 or any(data[HASH_SIZE:separator])):
+        raise ValueError('The wrapped session key is not correctly padded')
+
+    return data[separator + 1:]
+
+
+def wrap_session_key(session_key: bytes, public_key: tuple[int, int]) -> bytes:
+    """Encrypt session_key with OAEP padding by using the public key.
+    Raise a ValueError if the modulus is too small for the padded key, that is if it has fewer than
+    MIN_HYBRID_KEY_SIZE bits.
+    Preconditions:
+        - len(session_key) == SESSION_KEY_SIZE
+    """
+    n, e = public_key
+    size = (n.bit_length() + 7) // 8
+    if n.bit_length() < MIN_HYBRID_KEY_SIZE:
+        raise ValueError(f'A modulus of {n.bit_length()} bits is too small to wrap a session key; it must have at '
+                         f'least {MIN_HYBRID_KEY_SIZE} bits')
+
+    return pow(int.from_bytes(oaep_pad(session_key, size), 'big'), e, n).to_bytes(size, 'big')
+
+
+def unwrap_session_key(wrapped: bytes, private_key: PrivateKey | tuple[int, int, int]) -> bytes:
+    """Decrypt the session key wrapped by wrap_session_key by using the private key.
+    Raise a ValueError if the private key does not match the public key the session key was wrapped with.
+    """
+    private_key = as_private_key(private_key)
+    value = private_key.decrypt_int(int.from_bytes(wrapped, 'big') % (private_key.p * private_key.q))
+    if value.bit_length() > 8 * len(wrapped):
+        raise ValueError('The wrapped session key is not correctly padded')
+
+    return oaep_unpad(value.to_bytes(len(wrapped), 'big'))
+
+
+def keystream(key: bytes, nonce: int, length: int) -> bytes:
+    """Return length bytes of keystream for the given session key and nonce, made from BLAKE2b in counter mode.
+    Preconditions:
+        - 0 <= nonce < 2 ** 32
+    """
+    blocks = [hashlib.blake2b(nonce.to_bytes(4, 'big') + counter.to_bytes(8, 'big'), key=key,
+                              person=b'match-stream').digest()
+              for counter in range(-(-length // 64))]
+
+    return b''.join(blocks)[:length]
+
+
+def symmetric_encrypt(data: bytes, key: bytes, nonce: int) -> bytes:
+    """Encrypt data with the given session key, XOR-ing it with the keystream for nonce.
+    The result is followed by a TAG_SIZE byte BLAKE2b tag of the nonce and the encrypted data.
+    Each nonce must only be used once with the same key.
+    Preconditions:
+        - 0 <= nonce < 2 ** 32
+    """
+    stream = keystream(key, nonce, len(data))
+    cyphertext = (int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(len(data), 'big')
+    tag = hashlib.blake2b(nonce.to_bytes(4, 'big') + cyphertext, key=key, person=b'match-tag',
+                          digest_size=TAG_SIZE).digest()
+
+    return cyphertext + tag
+
+
+def symmetric_decrypt(cyphertext: bytes, key: bytes, nonce: int) -> bytes:
+    """Decrypt the given cyphertext, produced by symmetric_encrypt with the same key and nonce.
+    Raise a ValueError if its tag does not match.
+    """
+    data, tag = cyphertext[:-TAG_SIZE], cyphertext[-TAG_SIZE:]
+    expected = hashlib.blake2b(nonce.to_bytes(4, 'big') + data, key=key, person=b'match-tag',
+                               digest_size=TAG_SIZE).digest()
+    if not hmac.compare_digest(tag, expected):
+        raise ValueError('The encrypted data has been modified or the session key is wrong')
+
+    stream = keystream(key, nonce, len(data))
+
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(stream, 'big')).to_bytes(len(data), 'big')
+
+
+def encrypt_record(record: list[str], public_key: tuple[int, int], mode: str = 'char') -> list[str | bytes]:
+    """Encrypt every field of the given record by using the public key.
+    In 'char' mode, every character is encrypted separately into a character (see file_encrypt_str).
+    In 'block' mode, every field is encrypted into bytes (see file_encrypt_bytes), unless the modulus of the
+    public key is too small for a block to hold a byte (see block_sizes), in which case 'char' mode is used.
+    In 'hybrid' mode, a new session key is wrapped with the public key (see wrap_session_key) and becomes the first
+    item of the result, followed by every field encrypted with the session key (see symmetric_encrypt). The
+    modulus must then have at least MIN_HYBRID_KEY_SIZE bits.
+    Empty fields are kept empty in 'char' mode.
+    Preconditions:
+        - mode in {'char', 'block', 'hybrid'}
+    """
+    if mode == 'hybrid':
+        session_key = secrets.token_bytes(SESSION_KEY_SIZE)
+        encrypted = [symmetric_encrypt(field.encode(), session_key, nonce) for nonce, field in enumerate(record)]
+        return [wrap_session_key(session_key, public_key)] + encrypted
+    elif mode == 'block' and public_key[0] > 256:
+        return [file_encrypt_bytes(field, public_key) for field in record]
+    else:
+        return [file_encrypt_str(field, public_key) if field else '' for field in record]
+
+
+def decrypt_record(record: list[str | bytes], private_key: PrivateKey | tuple[int, int, int],
+                   mode: str = 'char') -> list[str]:
+    """Decrypt every field of the given record, encrypted by encrypt_record in the given mode, by using the
+    private key.
+    Records encrypted in 'block' mode (bytes) and in 'char' mode (str) are told apart by the type of their fields.
+    Preconditions:
+        - mode in {'char', 'block', 'hybrid'}
+    """
+    private_key = as_private_key(private_key)
+
+    if mode == 'hybrid':
+        session_key = unwrap_session_key(record[0], private_key)
+        return [symmetric_decrypt(field, session_key, nonce).decode() for nonce, field in enumerate(record[1:])]
 
-    for char in cyphertext:
-        decrypted_text = decrypted_text + chr((ord(char) ** d) % n)
+    decrypted = []
+    for field in record:
+        if isinstance(field, bytes):
+            decrypted.append(file_decrypt_bytes(field, private_key))
+        elif field:
+            decrypted.append(file_decrypt_str(field, private_key))
+        else:
+            decrypted.append('')
 
-    return decrypted_text
+    return decrypted
 
 
 if __name__ == '__main__':
@@ -117,6 +706,7 @@ if __name__ == '__main__':
     import python_ta
     python_ta.check_all(config={
         'max-line-length': 120,
-        'extra-imports': ['csv', 'random', 'math'],
+        'extra-imports': ['csv', 'hashlib', 'hmac', 'mmap', 'os', 'queue', 'random', 'math', 'secrets', 'threading',
+                          'array', 'collections', 'concurrent.futures', 'typing'],
         'disable': ['forbidden-IO-import', 'unused-variable']
     })
@@ -10,14 +10,51 @@ This file is Copyright (c) 2023 Nicolas Dias Martins, Sana-E-Zehra Mehdi, Rohan
 """
 from __future__ import annotations
 
+import array
+import contextlib
 import csv
+import gc
+import heapq
+import itertools
+import os
+import pickle
 import random
-from typing import Optional
+import struct
+import threading
+from typing import Any, Iterator, NamedTuple, Optional
 
 from python_ta.contracts import check_contracts
 
 import data_security as cp
 
+# How patient data is encrypted: 'char' encrypts every character separately, 'block' packs as many bytes as fit
+# under the modulus of the patient's key into each encrypted block, and 'hybrid' only encrypts a session key with
+# the patient's key and encrypts the data with that session key (see data_security.encrypt_record). 'hybrid' needs
+# a KEY_SIZE of at least data_security.MIN_HYBRID_KEY_SIZE bits.
+ENCRYPTION_MODE = 'block'
+
+# The header of a network snapshot: a magic string, the snapshot format version, the generation of the snapshot
+# (see HealthNetwork.generation), and the modification time (in nanoseconds) and size of the csv file the network
+# was read from and of the passwords file its doctors were given passwords from. Later format versions keep the
+# first three fields in place, so that the generation of any snapshot can be read (see snapshot_generation).
+SNAPSHOT_HEADER = struct.Struct('>8sIqqqqq')
+SNAPSHOT_PREFIX = struct.Struct('>8sIq')
+SNAPSHOT_MAGIC = b'MDNETSNP'
+SNAPSHOT_VERSION = 14
+
+# The classes a network snapshot is made of, the only ones SnapshotUnpickler creates
+SNAPSHOT_CLASSES = {('database', name) for name in ['Channel', 'DoctorIndex', 'FacetCounts', 'HealthNetwork',
+                                                    'ImplicitChannels', 'LoadRanking', 'Medical', 'Office',
+                                                    'Patient']} | {('data_security', 'PrivateKey'), ('array', 'array'),
+                                                                   ('array', '_array_reconstructor')}
+
+# The number of patients an office can hold
+OFFICE_CAPACITY = 10
+
+# The number of bits of the modulus of patient keys, generated by data_security.generate_large_keys, or None to
+# make keys from the primes in primes.csv. Keys over 20 bits cannot be used in 'char' mode.
+KEY_SIZE = None
+
 
 @check_contracts
 class Patient:
@@ -41,7 +78,10 @@ class Patient:
         - current: The office the patient is currently at
         - destination: The office the patient is trying to go to
         - next_office: The next office of the patient
-        - encrypted_data = an encrypted list of the relevant data of the patient
+        - encrypted_data = an encrypted list of the relevant data of the patient (str or bytes, depending on
+        encryption_mode). It is kept packed into a single string in _encrypted_blob, with the positions where its
+        items end in _encrypted_ends, rather than as one object per item.
+        - encryption_mode: The mode encrypted_data was encrypted in (see ENCRYPTION_MODE)
         - password: The password that the patient created when signing up
         - public_key: The public_key of the patient
         - private_key: the private key of the patient
@@ -79,17 +119,23 @@ class Patient:
     current: Optional[Office]
     destination: Optional[Office]
     next_office: Optional[Office]
-    encrypted_data: list[str]
+    encrypted_data: list[str | bytes]
+    encryption_mode: str
     password: str
     public_key: Optional[tuple[int, int]]
-    private_key: Optional[tuple[int, int, int]]
+    private_key: Optional[cp.PrivateKey]
+    _encrypted_blob: str | bytes
+    _encrypted_ends: array.array
 
     def __init__(self, first_name: str, last_name: str, state: str, date_of_birth: tuple[int, int, int],
                  sex: str, gender: str, height: float, weight: float, language: str, email: str,
                  phone_number: int, prior_medication: Optional[list[str]],
                  allergies: Optional[list[str]], username: str, password: str, diagnosis: Optional[str],
-                 current: Optional[Office]) -> None:
+                 current: Optional[Office],
+                 keys: Optional[tuple[cp.PrivateKey, tuple[int, int]]] = None) -> None:
         """Initialize a new patient instance.
+        If keys is given, it holds the (private key, public key) that were saved for this patient, and the patient
+        is encrypted with them instead of being given new keys.
         """
         self.first_name = first_name
         self.last_name = last_name
@@ -110,8 +156,28 @@ class Patient:
         self.destination = None
         self.next_office = None
         self.diagnosis = diagnosis
+        if keys is None:
+            keys = cp.take_keys('primes.csv', KEY_SIZE)
+        self.private_key, self.public_key = keys
+        self.encryption_mode = ENCRYPTION_MODE
         self.encrypted_data = encrypt_patient_data(self)
 
+    @property
+    def encrypted_data(self) -> list[str | bytes]:
+        """Return the items of the encrypted data of this patient, unpacked from self._encrypted_blob.
+        """
+        blob, ends = self._encrypted_blob, self._encrypted_ends
+        return [blob[start:end] for start, end in zip(itertools.chain([0], ends), ends)]
+
+    @encrypted_data.setter
+    def encrypted_data(self, value: list[str | bytes]) -> None:
+        """Pack the items of value into self._encrypted_blob, and their ends into self._encrypted_ends.
+        Preconditions:
+            - all(type(item) == type(value[0]) for item in value)
+        """
+        self._encrypted_blob = value[0][:0].join(value) if value else ''
+        self._encrypted_ends = array.array('I', itertools.accumulate(len(item) for item in value))
+
     def to_string(self) -> str:
         """Return all the relevent patient information as a string.
         """
@@ -134,6 +200,74 @@ class Patient:
                                        self.email, self.phone_number, self.diagnosis]]
 
 
+class Categories:
+    """A dictionary encoding of a categorical field of doctors: each distinct value of the field is stored once,
+    and doctors hold its code instead, the position of the value in the table.
+    Instance Attributes:
+        - values: The distinct values of the field, in the order they were first encoded
+        - codes: A mapping of each value of the field to its code
+    Representation Invariants:
+        - all(self.codes[value] == code for code, value in enumerate(self.values))
+    """
+    values: list[str]
+    codes: dict[str, int]
+
+    def __init__(self) -> None:
+        """Initialize an empty table.
+        """
+        self.values = []
+        self.codes = {}
+
+    def encode(self, value: str) -> int:
+        """Return the code of value, adding value to the table if it is new.
+        """
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def lookup(self, value: str) -> Optional[int]:
+        """Return the code of value, or None if it was never encoded (so no doctor has it).
+        """
+        return self.codes.get(value)
+
+
+# The shared string table of each categorical field of doctors. Codes are only meaningful within one process, so
+# doctors and indexes are pickled with the values instead.
+CATEGORIES = {field: Categories() for field in ['classification', 'specialization', 'state', 'degree', 'gender']}
+
+
+class CategoricalField:
+    """An attribute of doctors whose value is kept in CATEGORIES, while the doctor only stores its code in the
+    attribute of the same name followed by '_code'.
+    Instance Attributes:
+        - field: The field of CATEGORIES the values are encoded in
+        - code: The name of the attribute holding the code
+    """
+    field: str
+    code: str
+
+    def __init__(self, field: str) -> None:
+        """Initialize an attribute encoded in CATEGORIES[field].
+        """
+        self.field = field
+        self.code = field + '_code'
+
+    def __get__(self, instance: Any, owner: Optional[type] = None) -> Any:
+        """Return the value of this attribute for instance.
+        """
+        if instance is None:
+            return self
+        return CATEGORIES[self.field].values[getattr(instance, self.code)]
+
+    def __set__(self, instance: Any, value: str) -> None:
+        """Set the value of this attribute for instance.
+        """
+        setattr(instance, self.code, CATEGORIES[self.field].encode(value))
+
+
 class Medical:
     """A doctor that represents doctor data in a telemental health network.
         Instance Attributes
@@ -152,6 +286,8 @@ class Medical:
             - passw: Corresponding password of the doctor
             - public_key: The public_key of the doctor
             - private_key: the private key of the doctor
+            - state_code, degree_code, gender_code, specialization_code: The codes of state, degree, gender and
+            specialization in CATEGORIES, which are how these attributes are stored
         Representation Invariants:
             - len(self.first_name) > 0
             - len(self.last_name) > 0
@@ -176,6 +312,18 @@ class Medical:
     specialization: str
     user: str
     passw: str
+    state_code: int
+    degree_code: int
+    gender_code: int
+    specialization_code: int
+
+    __slots__ = ('profession', 'first_name', 'last_name', 'state_code', 'degree_code', 'gender_code', 'phone_number',
+                 'email', 'current_patients', 'specialization_code', 'user', 'passw')
+
+    state = CategoricalField('state')
+    degree = CategoricalField('degree')
+    gender = CategoricalField('gender')
+    specialization = CategoricalField('specialization')
 
     def __init__(self, profession: str, first_name: str, last_name: str, state: str, degree: str,
                  gender: str, email: str, specialization: str, phone_number: int, user: str, passw: str) -> None:
@@ -197,6 +345,18 @@ class Medical:
         self.user = user
         self.passw = passw
 
+    def __getstate__(self) -> dict[str, Any]:
+        """Return the attributes of this doctor to pickle, with the values of the categorical attributes rather
+        than their codes.
+        """
+        return {name.removesuffix('_code'): getattr(self, name.removesuffix('_code')) for name in self.__slots__}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        """Restore the attributes of an unpickled doctor, encoding its categorical attributes in this process.
+        """
+        for name, value in state.items():
+            setattr(self, name, value)
+
 
 @check_contracts
 class Office:
@@ -208,6 +368,8 @@ class Office:
         Each key in the mapping refers to the doctor's office, while the
         corresponding value refers to the channel leading into that node
     - waitlist: A list of patients that are waiting to be accepted by the office/doctor
+    - network: The network this office belongs to, or None if it does not belong to one
+    - office_id: The position of this office in its network, in the order offices were added
     Representation Invariants:
     - self.professional not in channels
     - all(self in self.channels[professional].endpoints for professional in self.channels)
@@ -217,13 +379,23 @@ class Office:
     patients: list[Patient]
     channels: dict[Medical, Channel]
     waitlist: list[Patient]
+    network: Optional[HealthNetwork]
+    office_id: int
 
-    def __init__(self, professional: Medical) -> None:
+    def __init__(self, professional: Medical, network: Optional[HealthNetwork] = None, office_id: int = 0) -> None:
         """Initialize this node with the given professional and no connections to other nodes.
+
+        If network is fully connected, a channel to any other office in network is created the
+        first time it is looked up in self.channels.
         """
         self.professional = professional
         self.patients = []
-        self.channels = {}
+        self.network = network
+        self.office_id = office_id
+        if network is not None and network.fully_connected:
+            self.channels = ImplicitChannels(self)
+        else:
+            self.channels = {}
         self.waitlist = []
 
     def waitlist_patient(self, patient: Patient) -> None:
@@ -232,18 +404,81 @@ class Office:
             - patient not in self.waitlist
             - patient not in self.patients
         """
-        self.waitlist.append(patient)
+        with network_lock(self.network):
+            self.waitlist.append(patient)
+            if self.network is not None:
+                self.network.refresh_office(self)
+                self.network.record('waitlist', self, patient)
 
     def add_patient(self, patient: Patient) -> None:
-        """Add patient as an actual patient of the office.
+        """Add patient as an actual patient of the office, and of the network the office belongs to.
         Preconditions:
             - patient not in self.patients
         """
-        self.patients.append(patient)
-        if patient in self.waitlist:
-            self.waitlist.remove(patient)
-        self.professional.current_patients.append(patient)
-        patient.current = self
+        with network_lock(self.network):
+            self.patients.append(patient)
+            if patient in self.waitlist:
+                self.waitlist.remove(patient)
+            self.professional.current_patients.append(patient)
+            patient.current = self
+            if self.network is not None:
+                self.network.patients[patient] = self
+                self.network.patients_by_user[patient.username] = patient
+                self.network.refresh_office(self)
+                self.network.record('add', self, patient)
+
+    def decline_patient(self, patient: Patient) -> None:
+        """Decline the request of patient to join the office: remove them from the waitlist, and clear their
+        current office and diagnosis (encrypting their data again without it).
+        """
+        with network_lock(self.network):
+            if patient in self.waitlist:
+                self.waitlist.remove(patient)
+            patient.current = None
+            patient.diagnosis = None
+            patient.encrypted_data = encrypt_patient_data(patient)
+            if self.network is not None:
+                self.network.refresh_office(self)
+                self.network.record('decline', self, patient)
+
+
+def network_lock(network: Optional[HealthNetwork]) -> Any:
+    """Return the lock of network to hold while mutating it, or a context manager doing nothing if network is None.
+    """
+    if network is None:
+        return contextlib.nullcontext()
+    return network.lock
+
+
+class ImplicitChannels(dict):
+    """The channels of an office in a fully connected network.
+
+    Only channels that have been used are stored. Looking up the channel to another office in the
+    same network creates it (and stores it in both offices) if it does not exist yet, so the
+    network behaves as if every pair of offices were connected.
+    Instance Attributes:
+        - office: The office these channels belong to
+    """
+    office: Office
+
+    __slots__ = ('office',)
+
+    def __init__(self, office: Office) -> None:
+        """Initialize an empty mapping of channels for office.
+        Preconditions:
+            - office.network is not None
+        """
+        super().__init__()
+        self.office = office
+
+    def __missing__(self, professional: Medical) -> Channel:
+        """Create and return the channel between self.office and the office of professional.
+        Raise a KeyError if professional does not own another office in the network.
+        """
+        offices = self.office.network.offices
+        if professional is self.office.professional or professional not in offices:
+            raise KeyError(professional)
+        return Channel(self.office, offices[professional])
 
 
 @check_contracts
@@ -307,6 +542,348 @@ class Channel:
         return old_occupant
 
 
+# The field of CATEGORIES the choices of each type of preference are encoded in
+PREFERENCE_FIELDS = {'Classification': 'classification', 'Specialization': 'specialization', 'State': 'state'}
+
+
+class DoctorIndex:
+    """An inverted index of doctors on the preferences a patient can filter by.
+    Instance Attributes:
+        - doctors: The indexed doctors, in the order they were added
+        - postings: A mapping of each type of preference ('Classification', 'Specialization' or 'State') to
+        a mapping of the code of each choice in CATEGORIES to the positions in self.doctors of the doctors that
+        match it
+        - specializations_of: A mapping of the code of each classification to the codes of the specializations of
+        the doctors with that classification
+    Representation Invariants:
+        - set(self.postings) == {'Classification', 'Specialization', 'State'}
+    """
+    doctors: list[Medical]
+    postings: dict[str, dict[int, set[int]]]
+    specializations_of: dict[int, set[int]]
+
+    def __init__(self, doctors: Optional[list[Medical]] = None) -> None:
+        """Initialize an index of the given doctors.
+        """
+        self.doctors = []
+        self.postings = {'Classification': {}, 'Specialization': {}, 'State': {}}
+        self.specializations_of = {}
+        if doctors is not None:
+            for doctor in doctors:
+                self.add_doctor(doctor)
+
+    def add_doctor(self, doctor: Medical) -> None:
+        """Add doctor to the index.
+        Preconditions:
+            - doctor not in self.doctors
+        """
+        position = len(self.doctors)
+        self.doctors.append(doctor)
+        keys = list(zip(FACETS, facet_key(doctor)))
+        for typec, code in keys:
+            self.postings[typec].setdefault(code, set()).add(position)
+        self.specializations_of.setdefault(keys[0][1], set()).add(doctor.specialization_code)
+
+    def __getstate__(self) -> dict[str, Any]:
+        """Return the attributes of this index to pickle, with the postings keyed by choice rather than by code.
+        """
+        postings = {typec: {CATEGORIES[PREFERENCE_FIELDS[typec]].values[code]: posting
+                            for code, posting in self.postings[typec].items()} for typec in self.postings}
+        specializations = CATEGORIES['specialization'].values
+        specializations_of = {CATEGORIES['classification'].values[code]: {specializations[spec] for spec in specs}
+                              for code, specs in self.specializations_of.items()}
+        return {'doctors': self.doctors, 'postings': postings, 'specializations_of': specializations_of}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        """Restore the attributes of an unpickled index, encoding its choices in this process.
+        """
+        self.doctors = state['doctors']
+        self.postings = {typec: {CATEGORIES[PREFERENCE_FIELDS[typec]].encode(choice): posting
+                                 for choice, posting in state['postings'][typec].items()}
+                         for typec in state['postings']}
+        self.specializations_of = {CATEGORIES['classification'].encode(choice):
+                                   {CATEGORIES['specialization'].encode(spec) for spec in specs}
+                                   for choice, specs in state['specializations_of'].items()}
+
+    def choices(self, typec: str) -> set[str]:
+        """Return every choice of the given type of preference that some doctor in the index matches.
+        Preconditions:
+            - typec in {'Classification', 'Specialization', 'State'}
+        """
+        values = CATEGORIES[PREFERENCE_FIELDS[typec]].values
+        return {values[code] for code, posting in self.postings[typec].items() if posting}
+
+    def specializations(self, profession: str) -> set[str]:
+        """Return the specializations of the doctors in the index whose classification is profession.
+        """
+        code = CATEGORIES['classification'].lookup(classification(profession == 'Psychologist'))
+        values = CATEGORIES['specialization'].values
+
+        return {values[spec] for spec in self.specializations_of.get(code, set())}
+
+    def search(self, preferences: list[list[str]]) -> list[Medical]:
+        """Return the doctors matching all the given preferences, in the order they were added.
+        Each item in preferences should look like [type of choice, choice].
+        Preconditions:
+            - all(len(list) == 2 for list in preferences)
+            - all(list[0] in {'Classification', 'Specialization', 'State'} for list in preferences)
+        """
+        if not preferences:
+            return list(self.doctors)
+
+        postings = []
+        for typec, choice in preferences:
+            if typec == 'Classification':
+                choice = classification(choice == 'Psychologist')
+            posting = self.postings[typec].get(CATEGORIES[PREFERENCE_FIELDS[typec]].lookup(choice))
+            if not posting:
+                return []
+            postings.append(posting)
+
+        # intersect starting from the shortest posting list
+        postings.sort(key=len)
+        positions = postings[0].intersection(*postings[1:])
+        return [self.doctors[position] for position in sorted(positions)]
+
+
+# The types of preference doctors are counted by in FacetCounts, in the order of the items of their keys
+FACETS = ['Classification', 'Specialization', 'State']
+
+
+def facet_key(doctor: Medical) -> tuple[int, int, int]:
+    """Return the codes in CATEGORIES of the classification, specialization and state of doctor.
+    """
+    return (CATEGORIES['classification'].encode(classification(doctor.profession)), doctor.specialization_code,
+            doctor.state_code)
+
+
+def decode_key(key: tuple[Optional[int], ...]) -> tuple[Optional[str], ...]:
+    """Return the choices of the codes in the given key of FACETS, leaving None items as they are.
+    """
+    return tuple(None if code is None else CATEGORIES[PREFERENCE_FIELDS[typec]].values[code]
+                 for typec, code in zip(FACETS, key))
+
+
+def encode_key(key: tuple[Optional[str], ...]) -> tuple[Optional[int], ...]:
+    """Return the codes of the choices in the given key of FACETS, leaving None items as they are.
+    """
+    return tuple(None if choice is None else CATEGORIES[PREFERENCE_FIELDS[typec]].encode(choice)
+                 for typec, choice in zip(FACETS, key))
+
+
+def selection_key(preferences: list[list[str]]) -> Optional[list[Optional[int]]]:
+    """Return the key of FACETS selected by the given preferences as a list, with None for the types of preference
+    not in preferences, or return None if some choice in preferences was never encoded (so no doctor matches it).
+    Preconditions:
+        - all(list[0] in FACETS for list in preferences)
+    """
+    key = [None] * len(FACETS)
+    for typec, choice in preferences:
+        if typec == 'Classification':
+            choice = classification(choice == 'Psychologist')
+        code = CATEGORIES[PREFERENCE_FIELDS[typec]].lookup(choice)
+        if code is None:
+            return None
+        key[FACETS.index(typec)] = code
+    return key
+
+
+def has_room(office: Office) -> bool:
+    """Return whether office has room for more patients: whether its patients and the patients waiting on its
+    waitlist are fewer than OFFICE_CAPACITY. This is what FacetCounts and LoadRanking count and rank offices by.
+    """
+    return len(office.patients) + len(office.waitlist) < OFFICE_CAPACITY
+
+
+class FacetCounts:
+    """The number of doctors with room for more patients in a network, for every selection of some (or none) of
+    a classification, a specialization and a state.
+    Instance Attributes:
+        - counts: A mapping of each key (classification, specialization, state), where each item is the code of a
+        choice in CATEGORIES or None for any choice, to the number of doctors with room for more patients that
+        match it. Keys with no doctors may be left out.
+        - available: The office_id of every office counted, which are the offices with room (see has_room)
+    Representation Invariants:
+        - all(len(key) == len(FACETS) for key in self.counts)
+        - self.counts.get((None, None, None), 0) == len(self.available)
+    """
+    counts: dict[tuple[Optional[int], Optional[int], Optional[int]], int]
+    available: set[int]
+
+    def __init__(self) -> None:
+        """Initialize counts of no doctors.
+        """
+        self.counts = {}
+        self.available = set()
+
+    def __getstate__(self) -> dict[str, Any]:
+        """Return the attributes of these counts to pickle, with the choices of the keys rather than their codes.
+        """
+        counts = {decode_key(key): count for key, count in self.counts.items()}
+        return {'counts': counts, 'available': self.available}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        """Restore the attributes of unpickled counts, encoding their choices in this process.
+        """
+        self.counts = {encode_key(key): count for key, count in state['counts'].items()}
+        self.available = state['available']
+
+    def update(self, office: Office) -> None:
+        """Start counting the doctor of office if it has room for more patients, or stop counting them if it is
+        full, in every count that matches them.
+        """
+        room = has_room(office)
+        if room == (office.office_id in self.available):
+            return
+
+        if room:
+            self.available.add(office.office_id)
+            change = 1
+        else:
+            self.available.remove(office.office_id)
+            change = -1
+
+        # every key where each item is either the doctor's choice or None
+        for key in itertools.product(*[(code, None) for code in facet_key(office.professional)]):
+            self.counts[key] = self.counts.get(key, 0) + change
+
+    def count(self, preferences: list[list[str]]) -> int:
+        """Return the number of doctors with room for more patients that match all the given preferences.
+        Preconditions:
+            - all(list[0] in FACETS for list in preferences)
+        """
+        key = selection_key(preferences)
+        if key is None:
+            return 0
+        return self.counts.get(tuple(key), 0)
+
+    def choices(self, typec: str, preferences: list[list[str]]) -> dict[str, int]:
+        """Return a mapping of each choice of the type typec to the number of doctors with room for more patients
+        that match it and all the given preferences, leaving out the choices that no such doctor matches.
+        Preconditions:
+            - typec in FACETS
+            - all(list[0] in FACETS and list[0] != typec for list in preferences)
+        """
+        key = selection_key(preferences)
+        if key is None:
+            return {}
+
+        position = FACETS.index(typec)
+        choices = {}
+        for code, choice in enumerate(CATEGORIES[PREFERENCE_FIELDS[typec]].values):
+            key[position] = code
+            count = self.counts.get(tuple(key), 0)
+            if count > 0:
+                choices[choice] = count
+        return choices
+
+
+class LoadRanking:
+    """A ranking of the offices of a network with room for more patients by their load, the number of patients
+    they hold or have waiting, with a min-heap of (load, office_id) for each key of FACETS (classification,
+    specialization, state).
+    Entries are never removed from the middle of a heap: an entry is stale once its office is full or has another
+    load, and is skipped (and dropped when it reaches the top of its heap).
+    Instance Attributes:
+        - heaps: A mapping of each key of FACETS to the heap of (load, office_id) entries of the offices whose
+        doctor matches it
+        - loads: A mapping of the office_id of each office with room for more patients to its load
+        - sizes: A mapping of each key of FACETS to the number of offices with an entry that is not stale in its
+        heap
+    Representation Invariants:
+        - all(self.sizes[key] <= len(self.heaps[key]) for key in self.heaps)
+    """
+    heaps: dict[tuple[int, int, int], list[tuple[int, int]]]
+    loads: dict[int, int]
+    sizes: dict[tuple[int, int, int], int]
+
+    def __init__(self) -> None:
+        """Initialize a ranking of no offices.
+        """
+        self.heaps = {}
+        self.loads = {}
+        self.sizes = {}
+
+    def __getstate__(self) -> dict[str, Any]:
+        """Return the attributes of this ranking to pickle, with the choices of the keys rather than their codes.
+        """
+        return {'heaps': {decode_key(key): heap for key, heap in self.heaps.items()}, 'loads': self.loads,
+                'sizes': {decode_key(key): size for key, size in self.sizes.items()}}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        """Restore the attributes of an unpickled ranking, encoding its choices in this process.
+        """
+        self.heaps = {encode_key(key): heap for key, heap in state['heaps'].items()}
+        self.loads = state['loads']
+        self.sizes = {encode_key(key): size for key, size in state['sizes'].items()}
+
+    def is_current(self, entry: tuple[int, int]) -> bool:
+        """Return whether the given (load, office_id) entry of a heap is not stale.
+        """
+        return self.loads.get(entry[1]) == entry[0]
+
+    def update(self, office: Office) -> None:
+        """Rank office by its current load if it has room for more patients, or stop ranking it if it is full.
+        """
+        key = facet_key(office.professional)
+        heap = self.heaps.setdefault(key, [])
+        load = len(office.patients) + len(office.waitlist)
+        previous = self.loads.get(office.office_id)
+
+        if not has_room(office):
+            if previous is not None:
+                del self.loads[office.office_id]
+                self.sizes[key] -= 1
+        elif previous != load:
+            self.loads[office.office_id] = load
+            self.sizes[key] = self.sizes.get(key, 0) + (previous is None)
+            heapq.heappush(heap, (load, office.office_id))
+
+        # rebuild the heap once most of its entries are stale
+        if len(heap) > 2 * self.sizes.get(key, 0) + 16:
+            heap[:] = [entry for entry in heap if self.is_current(entry)]
+            heapq.heapify(heap)
+
+    def matching_heaps(self, preferences: list[list[str]]) -> list[list[tuple[int, int]]]:
+        """Return the heaps of the keys matching all the given preferences, with their stale top entries dropped.
+        Preconditions:
+            - all(list[0] in FACETS for list in preferences)
+        """
+        selection = selection_key(preferences)
+        if selection is None:
+            return []
+        elif None not in selection:
+            heaps = [self.heaps.get(tuple(selection), [])]
+        else:
+            heaps = [heap for key, heap in self.heaps.items()
+                     if all(code is None or code == item for code, item in zip(selection, key))]
+
+        for heap in heaps:
+            while heap and not self.is_current(heap[0]):
+                heapq.heappop(heap)
+        return [heap for heap in heaps if heap]
+
+    def least_loaded(self, preferences: list[list[str]]) -> Optional[int]:
+        """Return the office_id of the least loaded office with room for more patients whose doctor matches all the
+        given preferences (the one added first, if there are ties), or None if there is none.
+        Preconditions:
+            - all(list[0] in FACETS for list in preferences)
+        """
+        heaps = self.matching_heaps(preferences)
+        if not heaps:
+            return None
+        return min(heap[0] for heap in heaps)[1]
+
+
+def classification(profession: bool) -> str:
+    """Return the classification of a doctor whose profession attribute is the given value.
+    """
+    if profession:
+        return 'Psychologist'
+    else:
+        return 'Counselor'
+
+
 @check_contracts
 class HealthNetwork:
     """Represents a health network of offices connected to each other, where a patient can move
@@ -314,26 +891,120 @@ class HealthNetwork:
     Instance Attributes:
         - offices: A mapping of office owner (doctor) to Office in this network
         - patients: A mapping of office occupant (patient) to Office in this network
+        - fully_connected: Whether every pair of offices is connected. Channels are then only created
+        the first time they are used (see ImplicitChannels).
+        - doctor_index: An index of the doctors in self.offices on the preferences a patient can filter by
+        - doctors_by_user: A mapping of username to the doctors in self.offices with that username, in the order
+        they were added (doctors who share a name share a username)
+        - patients_by_user: A mapping of username to the patient in self.patients with that username
+        - log: The log every mutation of this network and its offices is recorded in, or None if mutations are
+        not recorded. It is not saved in snapshots.
+        - lock: The lock held while this network or its offices are mutated, so that a snapshot can be saved from
+        another thread (see storage.NetworkLog). It is not saved in snapshots.
+        - generation: The generation of the last snapshot this network was saved to or restored from, or 0 if there
+        is none. A snapshot always has a higher generation than the one it replaces.
+        - ranking: The offices in self.offices with room for more patients, ranked by their load for each
+        selection of preferences
+        - facets: The number of doctors in self.offices with room for more patients for each selection of
+        preferences
     Representation Invariants:
         - all(doctor == offices[doctor].professional for doctor in offices)
+        - len(self.doctor_index.doctors) == len(self.offices)
     """
     offices: dict[Medical, Office]
     patients: dict[Patient, Office]
+    fully_connected: bool
+    doctor_index: DoctorIndex
+    doctors_by_user: dict[str, list[Medical]]
+    patients_by_user: dict[str, Patient]
+    log: Optional[Any]
+    lock: threading.RLock
+    generation: int
+    ranking: LoadRanking
+    facets: FacetCounts
 
-    def __init__(self) -> None:
+    def __init__(self, fully_connected: bool = False) -> None:
         """Initialize an empty health network instance.
         """
         self.offices = {}
         self.patients = {}
+        self.fully_connected = fully_connected
+        self.doctor_index = DoctorIndex()
+        self.doctors_by_user = {}
+        self.patients_by_user = {}
+        self.log = None
+        self.lock = threading.RLock()
+        self.generation = 0
+        self.ranking = LoadRanking()
+        self.facets = FacetCounts()
+
+    def __getstate__(self) -> dict:
+        """Return the state of this network to save in a snapshot, leaving out its log and lock.
+        """
+        state = self.__dict__.copy()
+        state['log'] = None
+        state['lock'] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        """Restore the state of a network from a snapshot, with a new lock.
+        """
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def least_loaded_office(self, preferences: list[list[str]]) -> Optional[Office]:
+        """Return the office with room for more patients and the fewest patients and waitlisted patients whose
+        doctor matches all the given preferences, or None if there is none.
+        Preconditions:
+            - all(len(list) == 2 for list in preferences)
+            - all(list[0] in FACETS for list in preferences)
+        """
+        office_id = self.ranking.least_loaded(preferences)
+        if office_id is None:
+            return None
+        return self.offices[self.doctor_index.doctors[office_id]]
+
+    def refresh_office(self, office: Office) -> None:
+        """Update what this network keeps track of about the load of office, after its patients or waitlist
+        changed.
+        Preconditions:
+            - office in self.offices.values()
+        """
+        self.ranking.update(office)
+        self.facets.update(office)
+
+    def record(self, kind: str, *args: Any) -> None:
+        """Record a mutation of the given kind with the given arguments in self.log, if there is one.
+        """
+        if self.log is not None:
+            self.log.record(kind, *args)
 
     def add_office(self, professional: Medical) -> Office:
         """Add a new office to the network and return it.
         Preconditions:
             - professional not in self.offices
         """
-        new_office = Office(professional)
-        self.offices[professional] = new_office
-        return new_office
+        with self.lock:
+            new_office = Office(professional, self, len(self.offices))
+            self.offices[professional] = new_office
+            self.doctor_index.add_doctor(professional)
+            self.doctors_by_user.setdefault(professional.user, []).append(professional)
+            self.refresh_office(new_office)
+            return new_office
+
+    def authenticate_doctor(self, user: str, passw: str) -> Optional[Medical]:
+        """Return the doctor in this network with the given username and password (the one added last, if there
+        are several), or None if there is none.
+        """
+        for doctor in reversed(self.doctors_by_user.get(user, [])):
+            if doctor.passw == passw:
+                return doctor
+        return None
+
+    def find_patient(self, username: str) -> Optional[Patient]:
+        """Return the patient in this network with the given username, or None if there is none.
+        """
+        return self.patients_by_user.get(username)
 
     def add_channel(self, office1: Medical, office2: Medical) -> None:
         """Create a new channel between the given offices.
@@ -349,98 +1020,239 @@ class HealthNetwork:
         Preconditions:
             - patient not in self.patients
             - any(office == self.offices[doctor] for doctor in self.offices)
-            - patient.current_office is None
+            - patient.current is None
         """
-        if len(office.patients) < 10:
-            office.patients.append(patient)
-            office.professional.current_patients.append(patient)
-            self.patients[patient] = office
-            return True
-        else:
-            return False
+        with self.lock:
+            if len(office.patients) < OFFICE_CAPACITY:
+                office.add_patient(patient)
+                return True
+            else:
+                return False
 
     def remove_patient(self, patient: Patient) -> None:
         """Remove patient from network.
         Preconditions:
             - patient in self.patients
-            - patient.current_office is not None
+            - patient.current is not None
+        """
+        with self.lock:
+            patient.current.professional.current_patients.remove(patient)
+            patient.current.patients.remove(patient)
+            self.refresh_office(patient.current)
+            self.patients.pop(patient)
+            if self.patients_by_user.get(patient.username) is patient:
+                self.patients_by_user.pop(patient.username)
+            self.record('remove', patient)
+
+    def set_diagnosis(self, patient: Patient, diagnosis: str) -> None:
+        """Set the diagnosis of patient, and encrypt its data again so that it holds the new diagnosis.
+        """
+        with self.lock:
+            patient.diagnosis = diagnosis
+            patient.encrypted_data = encrypt_patient_data(patient)
+            self.record('diagnosis', patient, diagnosis)
+
+    def save_snapshot(self, path: str, csv_file: str, passwords_file: str = 'passwords.csv') -> None:
+        """Save a binary snapshot of this network (offices, patients, waitlists and indexes) to path.
+        csv_file is the file this network was read from and passwords_file the file its doctors were given
+        passwords from; the snapshot is only restored by load_snapshot while neither file has changed.
+        The snapshot is given a higher generation than both this network and the snapshot it replaces.
         """
-        patient.current_office.professional.current_patients.remove(patient)
-        patient.current_office.patients.remove(patient)
-        self.patients.pop(patient)
+        with self.lock:
+            temporary_file = path + '.tmp'
+            self.generation = max(self.generation, snapshot_generation(path)) + 1
+            header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.generation,
+                                          *source_stats(csv_file, passwords_file))
+
+            with open(temporary_file, 'wb') as file:
+                file.write(header)
+                pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_file, path)
 
     def move_patient(self, patient: Patient) -> None:
         """Move patient towards desired office.
         Preconditions:
-            - patient.current_office is not None
+            - patient.current is not None
+            - patient.destination is not None
         """
-        channel = patient.current_office.channels[patient.destination.professional]
+        with self.lock:
+            self.record('move', patient, patient.destination)
+            channel = patient.current.channels[patient.destination.professional]
 
-        if channel.occupant is None:
-            if len(patient.destination.current_patients) < 10:
-                patient.destination.patients.append(patient)
-                patient.destination.professional.current_patients.append(patient)
-                patient.current_office = patient.destination
-                self.patients[patient] = patient.destination
+            if channel.occupant is None:
+                if len(patient.destination.patients) < OFFICE_CAPACITY:
+                    patient.destination.patients.append(patient)
+                    patient.destination.professional.current_patients.append(patient)
+                    self.refresh_office(patient.destination)
+                    patient.current = patient.destination
+                    self.patients[patient] = patient.destination
+                else:
+                    channel.occupant = patient
             else:
-                channel.occupant = patient
-        else:
-            channel.waitlist.append(patient)
+                channel.buffer.append(patient)
 
 
 def encrypt_patient_data(patient: Patient) -> list:
-    """ Encrypt patient data and return it as a list.
+    """ Encrypt patient data with the public key of the patient and return it as a list.
     """
-    encrypted_data = []
-    patient_data = patient.to_list()
+    return cp.encrypt_record(patient.to_list(), patient.public_key, patient.encryption_mode)
 
-    patient.private_key, patient.public_key = cp.generate_keys('primes.csv')
 
-    for data in patient_data:
-        encrypted_data += [cp.file_encrypt_str(str(data), patient.public_key)]
+def decrypt_patient_data(patient: Patient) -> list:
+    """Returns a list of decrypted patient data.
+        """
+    return cp.decrypt_record(patient.encrypted_data, patient.private_key, patient.encryption_mode)
 
-    return encrypted_data
 
+class SnapshotUnpickler(pickle.Unpickler):
+    """An unpickler that only creates the classes in SNAPSHOT_CLASSES, so that a snapshot (or a logged event)
+    someone has tampered with cannot make it call anything else.
+    """
 
-def decrypt_patient_data(patient: Patient) -> list:
-    """Returns a list of decrypted patient data.
+    def find_class(self, module: str, name: str) -> Any:
+        """Return the class name of module, or raise an UnpicklingError if it is not in SNAPSHOT_CLASSES.
         """
-    decrypted_data = []
-    encryted = patient.encrypted_data
+        if (module, name) not in SNAPSHOT_CLASSES:
+            raise pickle.UnpicklingError(f'{module}.{name} cannot be restored from a snapshot')
+
+        return super().find_class(module, name)
 
-    for data in encryted:
-        decrypted_data += [cp.file_decrypt_str(data, patient.private_key)]
 
-    return decrypted_data
+def source_stats(csv_file: str, passwords_file: str) -> tuple[int, int, int, int]:
+    """Return the modification time (in nanoseconds) and size of csv_file and of passwords_file.
+    """
+    csv_stat, passwords_stat = os.stat(csv_file), os.stat(passwords_file)
 
+    return (csv_stat.st_mtime_ns, csv_stat.st_size, passwords_stat.st_mtime_ns, passwords_stat.st_size)
 
-def read_network(csv_file: str) -> HealthNetwork:
-    """ Reads a csv_file and turns its content into a network, returning it by the end.
+
+def snapshot_generation(path: str) -> int:
+    """Return the generation of the snapshot in path, whatever its format version, or 0 if there is none.
     """
-    network = HealthNetwork()
-    offices = []
+    if not os.path.exists(path):
+        return 0
 
-    with open('passwords.csv') as passw:
-        passwords = list(csv.reader(passw))
+    with open(path, 'rb') as file:
+        prefix = file.read(SNAPSHOT_PREFIX.size)
+    if len(prefix) != SNAPSHOT_PREFIX.size or prefix[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        return 0
+
+    return max(SNAPSHOT_PREFIX.unpack(prefix)[2], 0)
+
+
+def load_snapshot(path: str, csv_file: str, passwords_file: str = 'passwords.csv') -> Optional[HealthNetwork]:
+    """Return the network saved to path by HealthNetwork.save_snapshot, or None if there is no snapshot at path,
+    it was saved in another format version, csv_file or passwords_file has changed since it was saved, or it holds
+    objects that are not part of a network (see SnapshotUnpickler).
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as file:
+        header = file.read(SNAPSHOT_HEADER.size)
+        if len(header) != SNAPSHOT_HEADER.size:
+            return None
+        magic, version, generation, *stats = SNAPSHOT_HEADER.unpack(header)
+        if (magic, version) != (SNAPSHOT_MAGIC, SNAPSHOT_VERSION) or \
+                tuple(stats) != source_stats(csv_file, passwords_file):
+            return None
+
+        # the garbage collector would otherwise keep scanning the objects being restored
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            network = SnapshotUnpickler(file).load()
+            network.generation = generation
+            return network
+        except pickle.UnpicklingError:
+            return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+
+def load_network(csv_file: str, snapshot_file: str, passwords_file: str = 'passwords.csv') -> HealthNetwork:
+    """Return the network of csv_file, whose doctors are given passwords from passwords_file, restored from the
+    snapshot in snapshot_file if it is up to date.
+    Otherwise, read the network from csv_file and save a new snapshot of it.
+    """
+    network = load_snapshot(snapshot_file, csv_file, passwords_file)
+
+    if network is None:
+        network = read_network(csv_file, passwords_file=passwords_file)
+        network.save_snapshot(snapshot_file, csv_file, passwords_file)
+
+    return network
+
+
+class DoctorRow(NamedTuple):
+    """A row of the medical dataset, holding the columns needed to create a doctor.
+    """
+    classification: str
+    specialization: str
+    first_name: str
+    last_name: str
+    state: str
+    credential: str
+    gender: str
+    phone: str
+
+
+# The column of the medical dataset each field of DoctorRow is read from
+DOCTOR_COLUMNS = ['Classification', 'Specializations', 'First Name', 'Last Name', 'Mailing Address State',
+                  'Credential', 'Gender', 'Business Address Phone']
 
+
+def iter_doctor_rows(csv_file: str, chunk_size: int = 1000) -> Iterator[list[DoctorRow]]:
+    """Yield the rows of the medical dataset csv_file in lists of at most chunk_size rows, reading the file as
+    they are needed.
+    Blank lines are skipped, and the last row of the file is not a doctor and is skipped, by always reading one
+    row ahead.
+    Preconditions:
+        - chunk_size > 0
+    """
     with open(csv_file) as file:
-        reader = list(csv.DictReader(file))
-        reader.pop()
+        reader = (row for row in csv.reader(file) if row)
+        header = next(reader)
+        columns = [header.index(column) for column in DOCTOR_COLUMNS]
 
+        chunk = []
+        previous = next(reader, None)
         for row in reader:
-            email = str.lower(row['First Name']) + '.' + str.lower(row['Last Name']) + '@gmail.com'
-            password = random.choice(passwords)
-            user = str.lower(row['First Name']) + '.' + str.lower(row['Last Name'])
-            medical = Medical(profession=row['Classification'], first_name=row['First Name'],
-                              last_name=row['Last Name'], state=row['Mailing Address State'], degree=row['Credential'],
-                              gender=row['Gender'], email=email, phone_number=row['Business Address Phone'], user=user,
-                              passw=password, specialization=row['Specializations'])
-            office = network.add_office(medical)
-
-            # all connected implementation:
-            for office2 in offices:
-                Channel(office, office2)
-            offices += [office]
+            chunk.append(DoctorRow(*[previous[column] for column in columns]))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+            previous = row
+
+        if chunk:
+            yield chunk
+
+
+def create_medical(row: DoctorRow, password: list[str]) -> Medical:
+    """Return the doctor described by the given row of the medical dataset, with the given password.
+    """
+    user = str.lower(row.first_name) + '.' + str.lower(row.last_name)
+
+    return Medical(profession=row.classification, first_name=row.first_name, last_name=row.last_name,
+                   state=row.state, degree=row.credential, gender=row.gender, email=user + '@gmail.com',
+                   phone_number=row.phone, user=user, passw=password, specialization=row.specialization)
+
+
+def read_network(csv_file: str, chunk_size: int = 1000, passwords_file: str = 'passwords.csv') -> HealthNetwork:
+    """ Reads a csv_file and turns its content into a network, returning it by the end.
+    The file is read chunk_size rows at a time, and the offices of each chunk are added before the next is read.
+    Every doctor is given a random password from passwords_file.
+    """
+    network = HealthNetwork(fully_connected=True)
+
+    with open(passwords_file) as passw:
+        passwords = list(csv.reader(passw))
+
+    for chunk in iter_doctor_rows(csv_file, chunk_size):
+        for row in chunk:
+            # all connected implementation: channels are created on first use
+            network.add_office(create_medical(row, random.choice(passwords)))
 
     return network
 
@@ -454,6 +1266,7 @@ if __name__ == '__main__':
 
     python_ta.check_all(config={
         'max-line-length': 120,
-        'extra-imports': ['csv', 'random', 'data_security'],
+        'extra-imports': ['array', 'contextlib', 'csv', 'gc', 'heapq', 'itertools', 'os', 'pickle', 'random',
+                          'struct', 'threading', 'data_security'],
         'disable': ['too-many-instance-attributes', 'too-many-arguments', 'too-many-locals', 'forbidden-IO-function'],
     })
@@ -11,14 +11,14 @@ expressly prohibited.
 This file is Copyright (c) 2023 Nicolas Dias Martins, Sana-E-Zehra Mehdi, Rohan Patra, and Maleeha Rahman.
 """
 from __future__ import annotations
-import random
 from tkinter.constants import BOTH, LEFT, N, NSEW, NW, S, TOP, X, YES
 from ttkbootstrap import Window
 import ttkbootstrap as ttk
-from patient_intake import all_states, get_specializations, list_filtered_doctors
-from database import Patient, Medical, HealthNetwork
-from interface_helpers import info_row, validate_length, check_user, check_pass, form_entry, combo, \
+from patient_intake import all_states, available_choices, get_specializations, least_loaded_doctor
+from database import OFFICE_CAPACITY, Patient, Medical, Office, HealthNetwork
+from interface_helpers import info_row, validate_length, check_pass, form_entry, combo, \
     validate_text, validate_phone, validate_email
+from storage import PatientJournal, load_keystore, load_patient_journal, load_patient_store
 
 
 def main_system(network: HealthNetwork, csv_file: str) -> None:
@@ -99,10 +99,7 @@ def sign_in_btn_doctor(app: ttk.Toplevel, user: ttk.StringVar, passw: ttk.String
     """
     This function creates the doctor window for doctors that sign in
     """
-    doc = None
-    for doctor in network.offices:
-        if user.get() == doctor.user and passw.get() == doctor.passw:
-            doc = doctor
+    doc = network.authenticate_doctor(user.get(), passw.get())
 
     if doc is not None:
         app.withdraw()
@@ -162,7 +159,7 @@ def sign_in_btn_doctor(app: ttk.Toplevel, user: ttk.StringVar, passw: ttk.String
             ), ttk.Button(
                 master=btn_row,
                 text='Decline',
-                command=lambda: decline_patient_btn(in_btn, decline_btn, patient),
+                command=lambda: decline_patient_btn(in_btn, decline_btn, network.offices[doc], patient),
                 width=len('Decline')
             )
 
@@ -196,7 +193,7 @@ def add_patient_btn(app: ttk.Toplevel, accept: ttk.Button, decline: ttk.Button,
                     doc: Medical, pat: Patient, frame: ttk.Frame(), network: HealthNetwork, csv_file: str) -> None:
     """Adds given patient as a button under current patients.
     """
-    if len(doc.current_patients) < 10:
+    if len(doc.current_patients) < OFFICE_CAPACITY:
         accept.destroy()
         decline.destroy()
         btn_row = frame
@@ -208,16 +205,15 @@ def add_patient_btn(app: ttk.Toplevel, accept: ttk.Button, decline: ttk.Button,
             width=len(f'{pat.first_name} {pat.last_name}')
         )
         in_btn.pack(padx=5)
-        doc.current_patients.append(pat)
+        network.offices[doc].add_patient(pat)
 
 
-def decline_patient_btn(accept: ttk.Button, decline: ttk.Button, pat: Patient) -> None:
+def decline_patient_btn(accept: ttk.Button, decline: ttk.Button, office: Office, pat: Patient) -> None:
     """Declining a patient. Removes option to add as patient. Changes patient current office and diagnosis to None.
     """
     accept.destroy()
     decline.destroy()
-    pat.current = None
-    pat.diagnosis = None
+    office.decline_patient(pat)
 
 
 def sign_out(win: ttk.Toplevel, network: HealthNetwork, csv_file: str) -> None:
@@ -307,7 +303,7 @@ def patient_btn(app: ttk.Toplevel, pat: Patient, network: HealthNetwork, csv_fil
     submit_btn = ttk.Button(
         master=btn_row,
         text="Submit",
-        command=lambda: submit_diagnosis(pat, user_var.get()),
+        command=lambda: submit_diagnosis(network, pat, user_var.get()),
         width=8
     )
     submit_btn.pack(padx=5)
@@ -315,10 +311,10 @@ def patient_btn(app: ttk.Toplevel, pat: Patient, network: HealthNetwork, csv_fil
     pat_win.mainloop()
 
 
-def submit_diagnosis(pat: Patient, diagnosis: str) -> None:
+def submit_diagnosis(network: HealthNetwork, pat: Patient, diagnosis: str) -> None:
     """Submits diagnosis to patient and presents window for confirmation.
     """
-    pat.diagnosis = diagnosis
+    network.set_diagnosis(pat, diagnosis)
     confirm_win = ttk.Toplevel(title='Sent')
     confirm_win.geometry('300x150')
 
@@ -367,7 +363,7 @@ def sign_up(app: ttk.Window, network: HealthNetwork, csv_file: str) -> None:
 
     form_entry("Phone", phone, sign_frame, app.register(validate_phone))
     form_entry("Email", email, sign_frame, app.register(validate_email))
-    state_comb = combo("State", sign_frame, list(all_states(csv_file)))
+    state_comb = combo("State", sign_frame, list(all_states(csv_file, network)))
 
     # create button to go to the next set of user input
     btn_row = ttk.Frame(sign_frame)
@@ -517,23 +513,11 @@ def sign_up_btn(app: ttk.Toplevel, first_name: ttk.StringVar, last_name: ttk.Str
                       prior_medication=val_med, allergies=val_allergies, username=val_user, password=val_passw,
                       sex=val_sex, diagnosis=None, current=None)
 
-        # write the new patient into the csv file
-        file = open('../Course Project/patient_info.csv', 'a')
-        file.write(pat.to_string())
-        file.write('\n')
-        file.close()
+        # save the keys so that the patient is not given new keys when signing in
+        load_keystore('../Course Project/patient_keys').save(pat)
 
-        al_file = open('../Course Project/patient_allergies.csv', 'a')
-        al_file.write(f'{pat.username}')
-        al_file.write(',' + ','.join(pat.allergies))
-        al_file.write('\n')
-        al_file.close()
-
-        med_file = open('../Course Project/patient_medication.csv', 'a')
-        med_file.write(f'{pat.username}')
-        med_file.write(',' + ','.join(pat.prior_medication))
-        med_file.write('\n')
-        med_file.close()
+        # record the new patient in the journal, which writes it into the csv files
+        patient_journal().record_patient(pat)
 
         # create label
         lbl_sign = ttk.Label(new_patient, text="Patient", font='Modern 30 bold')
@@ -657,19 +641,21 @@ def sign_in_btn(app: ttk.Toplevel, user: ttk.StringVar, passw: ttk.StringVar, ne
     """
     This function creates the patient window for patients that sign in
     """
-    row = check_user(user.get(), '../Course Project/patient_info.csv')
+    rows = patient_journal().lookup(user.get())
 
-    if row is not None and check_pass(passw.get(), row):
+    if rows is not None and check_pass(passw.get(), rows[0]):
+        row, pat_aller, pat_med = rows
         app.withdraw()
         patient_win = ttk.Toplevel(title='Patient')
         patient_win.geometry('800x650')
 
-        pat_aller = check_user(row[0], '../Course Project/patient_allergies.csv')
-        pat_med = check_user(row[0], '../Course Project/patient_medication.csv')
-
         aller_list = [pat_aller[x] for x in range(len(pat_aller)) if x != 0]
         med_list = [pat_med[x] for x in range(len(pat_med)) if x != 0]
 
+        # load the keys saved for the patient, if any
+        keystore = load_keystore('../Course Project/patient_keys')
+        keys = keystore.load(row[0])
+
         # create patient from csv since patient has no doctor
         pat = Patient(
             first_name=row[2],
@@ -688,14 +674,17 @@ def sign_in_btn(app: ttk.Toplevel, user: ttk.StringVar, passw: ttk.StringVar, ne
             diagnosis=row[15],
             current=None,
             username=row[0],
-            password=row[1]
+            password=row[1],
+            keys=keys
         )
+        if keys is None:
+            keystore.save(pat)
 
         # if the patient does have a doctor, find the existing patient attribute in the network
         if row[-1] is not None:
-            for patient in network.patients:
-                if patient.username == row[0] and patient.password == row[1]:
-                    pat = patient
+            patient = network.find_patient(row[0])
+            if patient is not None and patient.password == row[1]:
+                pat = patient
 
         # create label
         lbl_sign = ttk.Label(patient_win, text="Patient", font='Modern 30 bold')
@@ -784,6 +773,15 @@ def sign_in_btn(app: ttk.Toplevel, user: ttk.StringVar, passw: ttk.StringVar, ne
         patient_win.mainloop()
 
 
+def patient_journal() -> PatientJournal:
+    """
+    Return the journal of new patients, in front of the store of the patient csv files.
+    """
+    store = load_patient_store('../Course Project/patient_info.csv', '../Course Project/patient_allergies.csv',
+                               '../Course Project/patient_medication.csv')
+    return load_patient_journal('../Course Project/patients.journal', store)
+
+
 def find_doctor(csv_file: str, network: HealthNetwork, pat: Patient) -> None:
     """
     Find a doctor for the given patient.
@@ -838,8 +836,14 @@ def prof_btn(app: ttk.Toplevel, network: HealthNetwork, csv_file: str, prof_comb
     lbl_doc = ttk.Label(doc_frame, text='Select your preferences below.')
     lbl_doc.pack()
 
-    spec_comb = combo('Specialization', doc_frame, list(get_specializations(csv_file, prof_comb.get())))
-    state_comb = combo("State", doc_frame, list(all_states(csv_file)))
+    # only offer the choices with doctors who have room for the patient, unless there are none
+    specializations = available_choices(network, 'Specialization', [['Classification', prof_comb.get()]])
+    spec_comb = combo('Specialization', doc_frame,
+                      specializations or list(get_specializations(csv_file, prof_comb.get(), network)))
+    state_comb = combo("State", doc_frame, list(all_states(csv_file, network)))
+    update_states(network, csv_file, prof_comb, spec_comb, state_comb)
+    spec_comb.bind('<<ComboboxSelected>>',
+                   lambda event: update_states(network, csv_file, prof_comb, spec_comb, state_comb))
 
     # create button to find doctors
     btn_row = ttk.Frame(doc_frame)
@@ -855,6 +859,18 @@ def prof_btn(app: ttk.Toplevel, network: HealthNetwork, csv_file: str, prof_comb
     doc_win.mainloop()
 
 
+def update_states(network: HealthNetwork, csv_file: str, prof_comb: ttk.Combobox, spec_comb: ttk.Combobox,
+                  state_comb: ttk.Combobox) -> None:
+    """
+    Only offer the states with doctors who have room for the patient and match the selected profession and
+    specialization, or every state if there are none
+    """
+    states = available_choices(network, 'State', [['Classification', prof_comb.get()],
+                                                  ['Specialization', spec_comb.get()]])
+    state_comb['values'] = states or list(all_states(csv_file, network))
+    state_comb.current(0)
+
+
 def doc_btn(app: ttk.Toplevel, network: HealthNetwork, csv_file: str, prof_comb: ttk.Combobox, spec_comb: ttk.Combobox,
             state_comb: ttk.Combobox, pat: Patient) -> None:
     """
@@ -870,11 +886,11 @@ def doc_btn(app: ttk.Toplevel, network: HealthNetwork, csv_file: str, prof_comb:
     frame = ttk.LabelFrame(doc, text='Select a Doctor', padding=10)  # create frame
     frame.pack(fill=X, anchor=N, padx=30)
 
-    possible_docs = list_filtered_doctors(csv_file, [['Classification', prof_comb.get()],
-                                                     ['Specialization', spec_comb.get()], ['State', state_comb.get()]])
+    # the doctor with room for the patient and the fewest patients and waitlisted patients
+    doctor = least_loaded_doctor(network, [['Classification', prof_comb.get()],
+                                           ['Specialization', spec_comb.get()], ['State', state_comb.get()]])
 
-    if possible_docs:
-        doctor = random.choice(possible_docs)  # Display randomly generated doctor
+    if doctor is not None:
         info_row(frame, f'Name: {doctor.first_name} {doctor.last_name}')
         if doctor.profession is True:
             info_row(frame, 'Profession: Psychologist')
@@ -933,9 +949,9 @@ def yes_opt(app: ttk.Toplevel, pat: Patient, network: HealthNetwork, doc: Medica
     """
     The user selected yes to the doctor
     """
-    for doctor in network.offices:
-        if doctor.user == doc.user:
-            network.offices[doctor].waitlist.append(pat)
+    office = network.offices[doc]
+    if pat not in office.waitlist and pat not in office.patients:
+        office.waitlist_patient(pat)
     app.withdraw()
 
 
@@ -944,7 +960,7 @@ if __name__ == '__main__':
     python_ta.check_all(config={
         'max-line-length': 120,
         'extra-imports': ['patient_intake', 'database', 'ttkbootstrap', 'tkinter.constants', 'csv',
-                          'random', 'interface_helpers'],
+                          'interface_helpers', 'storage'],
         'disable': ['too-many-arguments', 'too-many-locals', 'forbidden-IO-function',
                     'consider-using-with', 'too-many-statements', 'too-many-nested-blocks', 'possibly-undefined']
     })
@@ -12,14 +12,22 @@ This file is Copyright (c) 2023 Nicolas Dias Martins, Sana-E-Zehra Mehdi, Rohan
 """
 
 import interface
-from database import read_network
+import data_security
+from database import ENCRYPTION_MODE, KEY_SIZE
+from storage import NetworkLog
 
 
 def main(csv_file: str) -> None:
     """
     This function runs the entire program.
     """
-    network = read_network(csv_file)
+    if ENCRYPTION_MODE == 'hybrid' and (KEY_SIZE is None or KEY_SIZE < data_security.MIN_HYBRID_KEY_SIZE):
+        raise ValueError(f"'hybrid' encryption needs a KEY_SIZE of at least {data_security.MIN_HYBRID_KEY_SIZE} bits")
+    if KEY_SIZE is None:
+        data_security.start_key_pool('primes.csv')
+    else:
+        data_security.start_key_cache(KEY_SIZE)
+    network = NetworkLog('network.log', 'network.snapshot', csv_file).recover()
     interface.main_system(network, csv_file)
 
 
@@ -31,5 +39,5 @@ if __name__ == '__main__':
     #
     # python_ta.check_all(config={
     #     'max-line-length': 120,
-    #     'extra-imports': ['interface', 'database'],
+    #     'extra-imports': ['interface', 'data_security', 'database', 'storage'],
     # })
@@ -12,7 +12,7 @@ import csv
 from typing import Optional
 import random
 from python_ta.contracts import check_contracts
-from database import Medical
+from database import CATEGORIES, Medical, HealthNetwork, create_medical, iter_doctor_rows
 
 
 @check_contracts
@@ -36,18 +36,20 @@ class ApplicationTree:
     doctors: list[Medical]
     parent: Optional[ApplicationTree]
 
-    def __init__(self, typec: str = None, parent: ApplicationTree = None, csv_file: str = None,
+    def __init__(self, typec: str = None, parent: ApplicationTree = None, network: HealthNetwork = None,
                  choice: str = '*') -> None:
         """Initialize a new ApplicationTree.
+        The start of the tree holds the doctors of the given network, so every doctor in the tree is a key of
+        network.offices.
 
         Pre-conditions:
-        - self.choice =! '*' or csv_file is not None.
+        - self.choice =! '*' or network is not None.
         - self.choice == '*' or parent is not None
         """
         self.choice = choice
         self.subtrees = {}
         if self.choice == '*':
-            self.doctors = create_doctors(csv_file)
+            self.doctors = list(network.offices)
             self.parent = None
             self.typec = None
         else:
@@ -87,14 +89,19 @@ class ApplicationTree:
         self.subtrees[tree.choice] = tree
 
 
-def all_states(csv_file: str) -> set[str]:
+def all_states(csv_file: str, network: Optional[HealthNetwork] = None) -> set[str]:
     """Return a set of all the states listed within the dataset.
+    If the network of the dataset is given, the states are taken from its doctor index instead of csv_file.
     """
+    if network is not None:
+        return network.doctor_index.choices('State')
+
     states = set()
 
     with open(csv_file) as f:
         for row in csv.DictReader(f):
-            states.add(row['Mailing Address State'])
+            if row['Mailing Address State']:
+                states.add(row['Mailing Address State'])
 
     return states
 
@@ -108,40 +115,61 @@ def check_profession(medical: str) -> bool:
         return False
 
 
-def get_specializations(csv_file: str, profession: str) -> set[str]:
+def get_specializations(csv_file: str, profession: str, network: Optional[HealthNetwork] = None) -> set[str]:
     """Returns a set of specializations based on the csv file and the profession
+    If the network of the dataset is given, the specializations are taken from its doctor index instead of csv_file.
     """
+    if network is not None:
+        return network.doctor_index.specializations(profession)
+
     specs = set()
 
     with open(csv_file) as f:
         for row in csv.reader(f):
-            if row[0] == profession:
+            # skip blank rows and rows too short to have a specialization
+            if len(row) > 1 and row[0] == profession:
                 specs.add(row[1])
 
     return specs
 
 
-def create_doctors(csv_file: str) -> list[Medical]:
+def least_loaded_doctor(network: HealthNetwork, preferences: list[list[str]]) -> Optional[Medical]:
+    """Returns the doctor in network based on patient's preferences who has room for more patients and the fewest
+    patients and waitlisted patients, or None if there is no such doctor.
+    each item in preferences should look like [type of choice, choice]
+
+    Preconditions:
+        - all(len(list) == 2 for list in preferences)
+        - all(list[0] in {'Classification', 'Specialization', 'State'} for list in preferences)
+    """
+    office = network.least_loaded_office(preferences)
+    if office is None:
+        return None
+    return office.professional
+
+
+def available_choices(network: HealthNetwork, typec: str, preferences: list[list[str]]) -> list[str]:
+    """Return the choices of the type typec matched by some doctor in network with room for more patients who also
+    matches all the given preferences, from the most to the least such doctors.
+    Preconditions:
+        - typec in {'Classification', 'Specialization', 'State'}
+        - all(list[0] in {'Classification', 'Specialization', 'State'} and list[0] != typec for list in preferences)
+    """
+    choices = network.facets.choices(typec, preferences)
+    return sorted(choices, key=lambda choice: (-choices[choice], choice))
+
+
+def create_doctors(csv_file: str, chunk_size: int = 1000) -> list[Medical]:
     """Create all the medical attributes in a given csv file.
+    The file is read chunk_size rows at a time.
     """
     doctors = []
 
     with open('../Course Project/passwords.csv') as passw:
         passwords = list(csv.reader(passw))
 
-    with open(csv_file) as file:
-        reader = list(csv.DictReader(file))
-        reader.pop()
-
-        for row in reader:
-            email = str.lower(row['First Name']) + '.' + str.lower(row['Last Name']) + '@gmail.com'
-            password = random.choice(passwords)
-            user = str.lower(row['First Name']) + '.' + str.lower(row['Last Name'])
-            doctors.append(Medical(profession=row['Classification'], first_name=row['First Name'],
-                                   last_name=row['Last Name'], state=row['Mailing Address State'],
-                                   degree=row['Credential'], gender=row['Gender'], email=email,
-                                   phone_number=row['Business Address Phone'], user=user, passw=password,
-                                   specialization=row['Specializations']))
+    for chunk in iter_doctor_rows(csv_file, chunk_size):
+        doctors.extend(create_medical(row, random.choice(passwords)) for row in chunk)
 
     return doctors
 
@@ -152,39 +180,39 @@ def filter_doctors(parent: ApplicationTree, subtree: ApplicationTree) -> list[Me
         - any(subtree in parent.subtrees[choice] for choice in parent.subtrees)
     """
     current_list = parent.doctors
-    filtered_list = []
 
-    for doctor in current_list:
-        if 'State' == subtree.typec:
-            if doctor.state == subtree.choice:
-                filtered_list.append(doctor)
-        if 'Specialization' == subtree.typec:
-            if subtree.choice == doctor.specialization:
-                filtered_list.append(doctor)
-        if 'Classification' == subtree.typec:
-            if doctor.profession == check_profession(subtree.choice):
-                filtered_list.append(doctor)
+    if 'Classification' == subtree.typec:
+        profession = check_profession(subtree.choice)
+        return [doctor for doctor in current_list if doctor.profession == profession]
 
-    return filtered_list
+    # compare the codes of the doctors' attributes with the code of the choice, rather than the strings
+    code = CATEGORIES[subtree.typec.lower()].lookup(subtree.choice)
+    if code is None:
+        return []
+    elif 'State' == subtree.typec:
+        return [doctor for doctor in current_list if doctor.state_code == code]
+    else:
+        return [doctor for doctor in current_list if doctor.specialization_code == code]
 
 
-def list_filtered_doctors(csv_file: str, preferences: list[list[str]]) -> list:
-    """Returns a list of possible doctors based on patient's preferences.
+def list_filtered_doctors(network: HealthNetwork, preferences: list[list[str]]) -> list[Medical]:
+    """Returns a list of possible doctors in network based on patient's preferences.
     each item in preferences should look like [type of choice, choice]
+    The returned doctors are keys of network.offices.
 
     Preconditions:
         - len(preferences) > 0
         - all(len(list) == 2 for list in preferences)
         - all(list[0] in {'Classification', 'Specialization', 'State'} for list in preferences)
 
-    >>> list_doctors = list_filtered_doctors('../Course Project/medical_dataset.csv', [['Classification', 'Psychologist'],
+    >>> from database import read_network
+    >>> network = read_network('../Course Project/medical_dataset.csv')
+    >>> list_doctors = list_filtered_doctors(network, [['Classification', 'Psychologist'],
      ['Specialization', 'Clinical'], ['State', 'CA']])
     >>> len(list_doctors) == 5
     True
     """
-    tree = ApplicationTree(csv_file=csv_file)
-    tree.insert_possible_choice(preferences)
-    return tree.subtrees[preferences[0][1]].subtrees[preferences[1][1]].subtrees[preferences[2][1]].doctors
+    return network.doctor_index.search(preferences)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,864 @@
+"""CSC111 Winter 2023 Course Project
+
+===============================
+This Python module contains the on-disk storage of patient and network data.
+
+Copyright and Usage Information
+===============================
+All forms of distribution of this code, whether as given or with any changes, are
+expressly prohibited.
+
+This file is Copyright (c) 2023 Nicolas Dias Martins, Sana-E-Zehra Mehdi, Rohan Patra, and Maleeha Rahman.
+"""
+from __future__ import annotations
+
+import atexit
+import csv
+import hashlib
+import io
+import json
+import os
+import pickle
+import secrets
+import shelve
+import struct
+import threading
+import time
+from typing import Any, BinaryIO, Optional
+
+import data_security as cp
+from database import HealthNetwork, Office, Patient, SnapshotUnpickler, load_network
+
+
+# The environment variable holding the secret that KeyStore encrypts private keys with
+KEYSTORE_SECRET_VARIABLE = 'PATIENT_KEYSTORE_SECRET'
+
+
+class KeyStore:
+    """A persistent store of the keys of patients, so that a returning patient does not need to be given new keys.
+    Every entry is keyed by the username of the patient and holds its public key and its private key, encrypted
+    with a secret that is never written to disk (see data_security.symmetric_encrypt). The encrypted data of a
+    patient is not stored: it is encrypted again from the csv tables with the stored keys, so it cannot drift from
+    them. Without a secret, nothing is saved or loaded.
+    Instance Attributes:
+        - path: The file the store is kept in
+    """
+    path: str
+    _secret: Optional[bytes]
+    _shelf: shelve.Shelf
+    _lock: threading.Lock
+
+    def __init__(self, path: str, secret: Optional[bytes]) -> None:
+        """Initialize the store kept in the given file, whose private keys are encrypted with secret, creating the
+        file if it does not exist.
+        """
+        self.path = path
+        self._secret = None if secret is None else hashlib.sha256(secret).digest()
+        self._shelf = shelve.open(path)
+        self._lock = threading.Lock()
+
+    def _entry_key(self, username: str, salt: bytes) -> bytes:
+        """Return the key the private key of username is encrypted with, derived from the secret and salt.
+        Preconditions:
+            - self._secret is not None
+        """
+        return hashlib.blake2b(salt + username.encode(), key=self._secret, digest_size=cp.SESSION_KEY_SIZE,
+                               person=b'match-keystore').digest()
+
+    def save(self, patient: Patient) -> None:
+        """Save the keys of patient, replacing any that were saved for its username.
+        """
+        if self._secret is None:
+            return
+
+        salt = secrets.token_bytes(16)
+        private_key = ','.join(str(value) for value in patient.private_key).encode()
+        sealed = cp.symmetric_encrypt(private_key, self._entry_key(patient.username, salt), 0)
+        with self._lock:
+            self._shelf[patient.username] = (patient.public_key, salt, sealed)
+            self._shelf.sync()
+
+    def load(self, username: str) -> Optional[tuple[cp.PrivateKey, tuple[int, int]]]:
+        """Return the keys saved for username, or None if none were saved for it (or they were saved with another
+        secret).
+        """
+        if self._secret is None:
+            return None
+
+        with self._lock:
+            if username not in self._shelf:
+                return None
+            entry = self._shelf[username]
+
+        try:
+            public_key, salt, sealed = entry
+            private_key = cp.symmetric_decrypt(sealed, self._entry_key(username, salt), 0)
+            p, q, d = (int(value) for value in private_key.decode().split(','))
+        except ValueError:
+            return None
+
+        return (cp.PrivateKey(p, q, d), public_key)
+
+    def close(self) -> None:
+        """Close the store.
+        """
+        with self._lock:
+            self._shelf.close()
+
+
+# The key store of each file, opened once by load_keystore
+_KEYSTORES: dict[str, KeyStore] = {}
+
+
+def load_keystore(path: str) -> KeyStore:
+    """Return the key store kept in the given file, opening it the first time it is requested with the secret in
+    the KEYSTORE_SECRET_VARIABLE environment variable, if it is set.
+    """
+    if path not in _KEYSTORES:
+        secret = os.environ.get(KEYSTORE_SECRET_VARIABLE)
+        _KEYSTORES[path] = KeyStore(path, None if not secret else secret.encode())
+
+    return _KEYSTORES[path]
+
+
+class PatientStore:
+    """The patient csv files (information, allergies and medication), along with an index of where the rows of
+    every patient start in each of them, so that a patient can be read with one seek per file.
+    The index is kept in a file next to the information file (with '.idx' added to its name). Every line of it
+    holds a username, the offsets of its rows in the three files (-1 if it has no row in a file) and the sizes of
+    the three files once those rows were written. If the last sizes do not match the files, the index is rebuilt
+    by scanning them.
+    Instance Attributes:
+        - files: The information, allergies and medication csv files, in that order
+        - index_file: The file the index is kept in
+        - offsets: A mapping of username to the offsets of its first row in each of self.files
+    Representation Invariants:
+        - len(self.files) == 3
+        - all(len(self.offsets[username]) == 3 for username in self.offsets)
+    """
+    files: tuple[str, str, str]
+    index_file: str
+    offsets: dict[str, tuple[int, int, int]]
+    _readers: list[Optional[BinaryIO]]
+    _lock: threading.Lock
+
+    def __init__(self, info_file: str, allergies_file: str, medication_file: str) -> None:
+        """Initialize the store of the given files, loading their index or rebuilding it if it is out of date.
+        """
+        self.files = (info_file, allergies_file, medication_file)
+        self.index_file = info_file + '.idx'
+        self.offsets = {}
+        self._readers = [None, None, None]
+        self._lock = threading.Lock()
+
+        if not self._load_index():
+            self._rebuild_index()
+
+    def _sizes(self) -> list[int]:
+        """Return the current sizes of self.files, counting missing files as empty.
+        """
+        return [os.path.getsize(file) if os.path.exists(file) else 0 for file in self.files]
+
+    def _load_index(self) -> bool:
+        """Load self.offsets from self.index_file and return whether it matches the current files.
+        An index with a malformed line (such as a line torn by a crash while it was written) does not match.
+        """
+        if not os.path.exists(self.index_file):
+            return self._sizes() == [0, 0, 0]
+
+        sizes = [0, 0, 0]
+        with open(self.index_file) as file:
+            for row in csv.reader(file):
+                if len(row) != 7:
+                    return False
+                try:
+                    offsets = (int(row[1]), int(row[2]), int(row[3]))
+                    sizes = [int(size) for size in row[4:7]]
+                except ValueError:
+                    return False
+                self.offsets[row[0]] = merge_offsets(self.offsets.get(row[0]), offsets)
+
+        return sizes == self._sizes()
+
+    def _rebuild_index(self) -> None:
+        """Rebuild self.offsets by scanning self.files, and rewrite self.index_file from it.
+        """
+        offsets = {}
+        for i, data_file in enumerate(self.files):
+            if not os.path.exists(data_file):
+                continue
+            with open(data_file, 'rb') as file:
+                position = 0
+                for line in file:
+                    username = line.split(b',', 1)[0].rstrip(b'\r\n').decode()
+                    offsets.setdefault(username, [-1, -1, -1])
+                    if offsets[username][i] == -1:
+                        offsets[username][i] = position
+                    position += len(line)
+
+        self.offsets = {username: tuple(offsets[username]) for username in offsets}
+        sizes = self._sizes()
+        with open(self.index_file, 'w', newline='') as file:
+            writer = csv.writer(file)
+            for username in self.offsets:
+                writer.writerow([username, *self.offsets[username], *sizes])
+
+    def lookup(self, username: str) -> Optional[tuple[list[str], list[str], list[str]]]:
+        """Return the information, allergies and medication rows of username (as parsed by csv.reader), or None
+        if username has no information row. A missing allergies or medication row is returned as [username].
+        """
+        with self._lock:
+            if username not in self.offsets or self.offsets[username][0] == -1:
+                return None
+
+            rows = []
+            for i, offset in enumerate(self.offsets[username]):
+                if offset == -1:
+                    rows.append([username])
+                else:
+                    reader = self._reader(i)
+                    reader.seek(offset)
+                    rows.append(next(csv.reader([reader.readline().decode()])))
+
+        return (rows[0], rows[1], rows[2])
+
+    def _reader(self, i: int) -> BinaryIO:
+        """Return the open reader of self.files[i], opening it if needed.
+        """
+        if self._readers[i] is None:
+            self._readers[i] = open(self.files[i], 'rb')
+
+        return self._readers[i]
+
+    def append(self, info: str, allergies: str, medication: str) -> None:
+        """Append the given rows (without line endings) to the information, allergies and medication files,
+        and add them to the index.
+        Preconditions:
+            - info, allergies and medication all start with the same username followed by a comma
+        """
+        self.append_many([(info, allergies, medication)])
+
+    def append_many(self, records: list[tuple[Optional[str], Optional[str], Optional[str]]]) -> None:
+        """Append the (information, allergies, medication) rows of every record to the files, opening each file
+        once, and add them to the index. A row that is None is not appended, so that a record can fill in the rows
+        a username is missing.
+        Preconditions:
+            - all(the rows of record that are not None start with the same username followed by a comma
+                  for record in records)
+            - all(any(row is not None for row in record) for record in records)
+        """
+        with self._lock:
+            offsets = [[], [], []]
+            for i, data_file in enumerate(self.files):
+                with open(data_file, 'ab') as file:
+                    position = file.tell()
+                    lines = []
+                    for record in records:
+                        if record[i] is None:
+                            offsets[i].append(-1)
+                        else:
+                            lines.append(record[i].encode() + b'\n')
+                            offsets[i].append(position)
+                            position += len(lines[-1])
+                    file.write(b''.join(lines))
+
+            sizes = self._sizes()
+            with open(self.index_file, 'a', newline='') as file:
+                writer = csv.writer(file)
+                for j, record in enumerate(records):
+                    username = next(row for row in record if row is not None).split(',', 1)[0]
+                    self.offsets[username] = merge_offsets(self.offsets.get(username),
+                                                           (offsets[0][j], offsets[1][j], offsets[2][j]))
+                    writer.writerow([username, *self.offsets[username], *sizes])
+
+    def close(self) -> None:
+        """Close the files opened by the store.
+        """
+        with self._lock:
+            for reader in self._readers:
+                if reader is not None:
+                    reader.close()
+            self._readers = [None, None, None]
+
+
+def merge_offsets(known: Optional[tuple[int, int, int]], new: tuple[int, int, int]) -> tuple[int, int, int]:
+    """Return the offsets of a username's rows given the offsets already known for it (None if there are none)
+    and the offsets of rows appended after them, keeping the first row of the username in each file.
+
+    >>> merge_offsets(None, (0, -1, -1))
+    (0, -1, -1)
+    >>> merge_offsets((0, -1, -1), (-1, 10, 20))
+    (0, 10, 20)
+    >>> merge_offsets((0, 10, 20), (30, 40, 50))
+    (0, 10, 20)
+    """
+    if known is None:
+        return new
+    else:
+        return (new[0] if known[0] == -1 else known[0], new[1] if known[1] == -1 else known[1],
+                new[2] if known[2] == -1 else known[2])
+
+
+def patient_rows(patient: Patient) -> tuple[str, str, str]:
+    """Return the information, allergies and medication csv rows of patient, without line endings.
+    """
+    return (patient.to_string(), f'{patient.username},' + ','.join(patient.allergies),
+            f'{patient.username},' + ','.join(patient.prior_medication))
+
+
+class PatientJournal:
+    """An append-only journal of new patients in front of a PatientStore.
+    Every patient is recorded as a single journal entry holding its information, allergies and medication rows.
+    Entries are written by a worker thread in batches with a single write and fsync each (group commit), and a
+    compaction thread regularly moves the written entries into the csv files of the store (rebuilding its
+    per-table views) and empties the journal. Entries left in the journal when the program stopped are moved into
+    the store when the journal is opened again, and the journal is closed (see close) when the program exits.
+    A left entry whose username already has different rows in the store is not moved into it: it is kept in
+    self.conflicts and appended to a file next to the journal (with '.conflicts' added to its name), so that it
+    can be resolved by hand.
+    Instance Attributes:
+        - path: The file the journal is kept in
+        - store: The store the journal is compacted into
+        - pending: A mapping of username to the rows of the patients recorded since the last compaction
+        - compact_interval: The number of seconds between compactions
+        - conflicts: The entries left in the journal that conflicted with the store when it was opened
+    """
+    path: str
+    store: PatientStore
+    pending: dict[str, tuple[str, str, str]]
+    compact_interval: float
+    conflicts: list[tuple[str, str, str]]
+    _queue: list[tuple[str, str, str]]
+    _written: list[tuple[str, str, str]]
+    _recorded: int
+    _durable: int
+    _condition: threading.Condition
+    _file_lock: threading.Lock
+    _closed: bool
+
+    def __init__(self, path: str, store: PatientStore, compact_interval: float = 5.0) -> None:
+        """Initialize the journal kept in the given file, move any entries left in it into store, and start the
+        worker threads.
+        """
+        self.path = path
+        self.store = store
+        self.pending = {}
+        self.compact_interval = compact_interval
+        self.conflicts = []
+        self._queue = []
+        self._written = []
+        self._recorded = 0
+        self._durable = 0
+        self._condition = threading.Condition()
+        self._file_lock = threading.Lock()
+        self._closed = False
+
+        self._recover()
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        threading.Thread(target=self._compact_loop, daemon=True).start()
+        atexit.register(self.close)
+
+    def _recover(self) -> None:
+        """Move the complete entries left in the journal file into the store, and empty the file.
+        An incomplete last entry (from a write that was interrupted) is dropped. The store may already hold some
+        or all of the rows of an entry, when the program stopped during a compaction: only the rows missing from
+        each of its files are appended. An entry whose username already has a different row in the store belongs
+        to another patient, and is reported as a conflict instead.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        records = []
+        with open(self.path, 'rb') as file:
+            for line in file:
+                if line.endswith(b'\n'):
+                    record = tuple(json.loads(line))
+                    missing = self._missing_rows(record)
+                    if missing is None:
+                        self.conflicts.append(record)
+                    elif any(row is not None for row in missing):
+                        records.append(missing)
+        if records:
+            self.store.append_many(records)
+        if self.conflicts:
+            with open(self.path + '.conflicts', 'ab') as file:
+                file.write(b''.join(json.dumps(record).encode() + b'\n' for record in self.conflicts))
+                file.flush()
+                os.fsync(file.fileno())
+        open(self.path, 'wb').close()
+
+    def _missing_rows(self, record: tuple[str, str, str]) -> Optional[tuple[Optional[str], ...]]:
+        """Return record with None in place of the rows the store already has, or None if the store has a
+        different row for the username of record.
+        """
+        username = record[0].split(',', 1)[0]
+        stored = self.store.lookup(username)
+        offsets = self.store.offsets.get(username, (-1, -1, -1))
+        if stored is None and offsets[0] != -1:
+            return None
+
+        missing = []
+        for i, row in enumerate(record):
+            if offsets[i] == -1:
+                missing.append(row)
+            elif stored is None or stored[i] != next(csv.reader([row])):
+                return None
+            else:
+                missing.append(None)
+
+        return tuple(missing)
+
+    def record(self, info: str, allergies: str, medication: str, wait: bool = True) -> None:
+        """Record a new patient with the given information, allergies and medication rows (without line endings).
+        If wait is True, return once the entry has been written to the journal and synced to disk.
+        Preconditions:
+            - info, allergies and medication all start with the same username followed by a comma
+        """
+        with self._condition:
+            self._queue.append((info, allergies, medication))
+            self.pending.setdefault(info.split(',', 1)[0], (info, allergies, medication))
+            self._recorded += 1
+            number = self._recorded
+            self._condition.notify_all()
+            while wait and self._durable < number:
+                self._condition.wait()
+
+    def record_patient(self, patient: Patient, wait: bool = True) -> None:
+        """Record patient as a new patient (see record).
+        """
+        self.record(*patient_rows(patient), wait=wait)
+
+    def lookup(self, username: str) -> Optional[tuple[list[str], list[str], list[str]]]:
+        """Return the information, allergies and medication rows of username, in the format returned by
+        PatientStore.lookup, whether or not its entry has been compacted into the store yet.
+        """
+        with self._condition:
+            rows = self.pending.get(username)
+
+        if rows is None:
+            return self.store.lookup(username)
+        else:
+            info, allergies, medication = [next(csv.reader([row])) for row in rows]
+            return (info, allergies, medication)
+
+    def _flush_loop(self) -> None:
+        """Write the recorded entries to the journal in batches, until the journal is closed.
+        """
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                batch, self._queue = self._queue, []
+                number = self._recorded
+
+            with self._file_lock:
+                with open(self.path, 'ab') as file:
+                    file.write(b''.join(json.dumps(record).encode() + b'\n' for record in batch))
+                    file.flush()
+                    os.fsync(file.fileno())
+                self._written.extend(batch)
+
+            with self._condition:
+                self._durable = number
+                self._condition.notify_all()
+
+    def _compact_loop(self) -> None:
+        """Compact the journal every self.compact_interval seconds, until the journal is closed.
+        """
+        while not self._closed:
+            time.sleep(self.compact_interval)
+            self.compact()
+
+    def compact(self) -> None:
+        """Move the entries written to the journal into the store, and empty the journal file.
+        """
+        with self._file_lock:
+            if not self._written:
+                return
+            self.store.append_many(self._written)
+            open(self.path, 'wb').close()
+            compacted, self._written = self._written, []
+
+        with self._condition:
+            for record in compacted:
+                username = record[0].split(',', 1)[0]
+                if self.pending.get(username) == record:
+                    self.pending.pop(username)
+
+    def close(self) -> None:
+        """Wait for every recorded entry to be written, stop the worker threads, then compact the journal one last
+        time.
+        """
+        with self._condition:
+            while self._durable < self._recorded:
+                self._condition.wait()
+            self._closed = True
+            self._condition.notify_all()
+        self.compact()
+
+
+# The journal of each file, opened once by load_patient_journal
+_PATIENT_JOURNALS: dict[str, PatientJournal] = {}
+
+
+def load_patient_journal(path: str, store: PatientStore) -> PatientJournal:
+    """Return the journal kept in the given file in front of store, opening it the first time it is requested.
+    """
+    if path not in _PATIENT_JOURNALS:
+        _PATIENT_JOURNALS[path] = PatientJournal(path, store)
+
+    return _PATIENT_JOURNALS[path]
+
+
+# The patient store of each information file, opened once by load_patient_store
+_PATIENT_STORES: dict[str, PatientStore] = {}
+
+
+def load_patient_store(info_file: str, allergies_file: str, medication_file: str) -> PatientStore:
+    """Return the patient store of the given files, opening it the first time it is requested.
+    """
+    if info_file not in _PATIENT_STORES:
+        _PATIENT_STORES[info_file] = PatientStore(info_file, allergies_file, medication_file)
+
+    return _PATIENT_STORES[info_file]
+
+
+# The header of a network log: a magic string and the generation of the snapshot the log starts from (see
+# HealthNetwork.generation). Every event after it is a pickled tuple preceded by its length.
+LOG_HEADER = struct.Struct('>8sq')
+LOG_MAGIC = b'MDNETLOG'
+EVENT_LENGTH = struct.Struct('>I')
+
+# The attributes of a patient that are needed to create it again when replaying a network log
+PATIENT_FIELDS = ['first_name', 'last_name', 'state', 'date_of_birth', 'sex', 'gender', 'height', 'weight', 'language',
+                  'email', 'phone_number', 'prior_medication', 'allergies', 'username', 'password', 'diagnosis']
+
+
+class NetworkLog:
+    """An append-only log of the mutations of a HealthNetwork since its last snapshot.
+    Every mutation is recorded as a compact event in which offices are referred to by their office_id and patients
+    by their username. A patient is recorded in full (a 'patient' event) the first time an event refers to it.
+    Events are written by a worker thread in batches with a single write and fsync each. Every
+    checkpoint_interval events, the worker thread also saves a new snapshot of the network and empties the log, so
+    replaying the log never takes much more than checkpoint_interval events. It holds the lock of the network while
+    it does, so the snapshot is never taken in the middle of a mutation. The events not written yet when the program
+    exits are written by close, which recover registers to run at exit.
+    Instance Attributes:
+        - path: The file the log is kept in
+        - snapshot_file: The file the snapshots of the network are saved to
+        - csv_file: The csv file the network was read from
+        - passwords_file: The file the doctors of the network were given passwords from
+        - network: The network whose mutations are recorded, or None before recover is called
+        - checkpoint_interval: The number of events between snapshots
+        - events: The number of events recorded since the last snapshot
+        - checkpoint_due: Whether the worker thread should save a snapshot and empty the log
+    """
+    path: str
+    snapshot_file: str
+    csv_file: str
+    passwords_file: str
+    network: Optional[HealthNetwork]
+    checkpoint_interval: int
+    events: int
+    checkpoint_due: bool
+    _known: dict[str, Patient]
+    _queue: list[bytes]
+    _queued: int
+    _durable: int
+    _condition: threading.Condition
+    _file_lock: threading.Lock
+    _closed: bool
+
+    def __init__(self, path: str, snapshot_file: str, csv_file: str, checkpoint_interval: int = 1000,
+                 passwords_file: str = 'passwords.csv') -> None:
+        """Initialize the log kept in path for the network of csv_file (whose doctors are given passwords from
+        passwords_file), whose snapshots are saved to snapshot_file, and start its worker thread.
+        """
+        self.path = path
+        self.snapshot_file = snapshot_file
+        self.csv_file = csv_file
+        self.passwords_file = passwords_file
+        self.network = None
+        self.checkpoint_interval = checkpoint_interval
+        self.events = 0
+        self.checkpoint_due = False
+        self._known = {}
+        self._queue = []
+        self._queued = 0
+        self._durable = 0
+        self._condition = threading.Condition()
+        self._file_lock = threading.Lock()
+        self._closed = False
+
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def recover(self) -> HealthNetwork:
+        """Return the network restored from the last snapshot and the events logged since, and start recording
+        its mutations in this log.
+        The events are dropped if they do not start from the current snapshot (for example, if the snapshot was
+        rebuilt because the csv file changed or was deleted).
+
+        >>> import tempfile
+        >>> from database import Patient
+        >>> directory = tempfile.mkdtemp()
+        >>> log, snapshot, medical, passwords = [os.path.join(directory, name) for name in
+        ...                                      ['network.log', 'network.snapshot', 'medical.csv', 'passwords.csv']]
+        >>> with open(passwords, 'w') as file:
+        ...     _ = file.write('password\\n')
+        >>> with open(medical, 'w') as file:
+        ...     _ = file.write('Classification,Specializations,First Name,Last Name,Mailing Address State,'
+        ...                    'Credential,Gender,Business Address Phone\\n'
+        ...                    'Psychologist,Clinical,Ann,Lee,CA,PhD,F,5550001111\\n,,,,,,,\\n')
+        >>> network = NetworkLog(log, snapshot, medical, passwords_file=passwords).recover()
+        >>> office = list(network.offices.values())[0]
+        >>> patient = Patient('Jane', 'Doe', 'CA', (4, 12, 1998), 'Female', 'Woman', 165.0, 60.0, 'English',
+        ...                   'jane@gmail.com', 4165550123, [], [], 'jdoe', 'secret', None, None,
+        ...                   (cp.PrivateKey(61, 53, 2753), (3233, 17)))
+        >>> office.waitlist_patient(patient)
+        >>> office.add_patient(patient)
+        >>> network.log.flush()
+
+        An interrupted write of the last event (here, adding the patient) only loses that event:
+        >>> with open(log, 'r+b') as file:
+        ...     _ = file.truncate(os.path.getsize(log) - 3)
+        >>> network = NetworkLog(log, snapshot, medical, passwords_file=passwords).recover()
+        >>> office = list(network.offices.values())[0]
+        >>> [patient.username for patient in office.waitlist], network.find_patient('jdoe')
+        (['jdoe'], None)
+        >>> office.add_patient(office.waitlist[0])
+        >>> network.log.flush()
+        >>> network = NetworkLog(log, snapshot, medical, passwords_file=passwords).recover()
+        >>> network.find_patient('jdoe').current.office_id
+        0
+
+        A log that does not start from the current snapshot is dropped:
+        >>> network.set_diagnosis(network.find_patient('jdoe'), 'Anxiety')
+        >>> network.log.flush()
+        >>> os.remove(snapshot)
+        >>> network = NetworkLog(log, snapshot, medical, passwords_file=passwords).recover()
+        >>> network.find_patient('jdoe') is None
+        True
+        """
+        # a log whose snapshot is gone is dropped, even if the new snapshot is given the same generation
+        orphaned = not os.path.exists(self.snapshot_file)
+        network = load_network(self.csv_file, self.snapshot_file, self.passwords_file)
+        patients = all_patients(network)
+
+        self.network = network
+        events = None if orphaned else self._read_events()
+        if events is None:
+            # the snapshot is the network as it was loaded (or, on a cold start, as load_network just saved it)
+            self._reset()
+        elif events:
+            for event in events:
+                apply_event(network, patients, event)
+            self.checkpoint()
+        else:
+            self._known = patients
+        network.log = self
+        atexit.register(self.close)
+
+        return network
+
+    def _read_events(self) -> Optional[list[tuple]]:
+        """Return the complete events in the log file, or None if the log does not start from the current
+        snapshot. An incomplete last event (from a write that was interrupted) is dropped, and so is every event
+        from the first one that cannot be restored (see SnapshotUnpickler).
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        events = []
+        with open(self.path, 'rb') as file:
+            if file.read(LOG_HEADER.size) != self._header():
+                return None
+            while True:
+                length = file.read(EVENT_LENGTH.size)
+                if len(length) != EVENT_LENGTH.size:
+                    break
+                data = file.read(EVENT_LENGTH.unpack(length)[0])
+                if len(data) != EVENT_LENGTH.unpack(length)[0]:
+                    break
+                try:
+                    events.append(SnapshotUnpickler(io.BytesIO(data)).load())
+                except pickle.UnpicklingError:
+                    break
+
+        return events
+
+    def _header(self) -> bytes:
+        """Return the header of a log starting from the current snapshot.
+        Preconditions:
+            - self.network is not None
+        """
+        return LOG_HEADER.pack(LOG_MAGIC, self.network.generation)
+
+    def record(self, kind: str, *args: Any) -> None:
+        """Record a mutation of the given kind with the given arguments, where offices and patients are given as
+        Office and Patient objects. The event is written to disk in the background (see flush).
+        """
+        events = []
+        values = []
+        for arg in args:
+            if isinstance(arg, Office):
+                values.append(arg.office_id)
+            elif isinstance(arg, Patient):
+                if self._known.get(arg.username) is not arg:
+                    self._known[arg.username] = arg
+                    events.append(('patient', patient_state(arg)))
+                values.append(arg.username)
+            else:
+                values.append(arg)
+        events.append((kind, *values))
+
+        with self._condition:
+            for event in events:
+                data = pickle.dumps(event, protocol=pickle.HIGHEST_PROTOCOL)
+                self._queue.append(EVENT_LENGTH.pack(len(data)) + data)
+            self._queued += len(events)
+            self.events += len(events)
+            if self.events >= self.checkpoint_interval:
+                self.checkpoint_due = True
+            self._condition.notify_all()
+
+    def _flush_loop(self) -> None:
+        """Write the recorded events to the log in batches, and save a snapshot when one is due, until the log is
+        closed.
+        """
+        while True:
+            with self._condition:
+                while not self._queue and not self.checkpoint_due and not self._closed:
+                    self._condition.wait()
+                if self._closed and not self._queue:
+                    return
+                if self.checkpoint_due:
+                    self.checkpoint_due = False
+                    checkpoint = True
+                else:
+                    checkpoint = False
+                batch, self._queue = self._queue, []
+                number = self._queued
+
+            if checkpoint:
+                self.checkpoint()
+                continue
+
+            with self._file_lock:
+                with open(self.path, 'ab') as file:
+                    file.write(b''.join(batch))
+                    file.flush()
+                    os.fsync(file.fileno())
+
+            with self._condition:
+                self._durable = number
+                self._condition.notify_all()
+
+    def flush(self) -> None:
+        """Wait until every recorded event has been written to the log and synced to disk.
+        """
+        with self._condition:
+            while self._durable < self._queued:
+                self._condition.wait()
+
+    def close(self) -> None:
+        """Write every recorded event to the log and stop the worker thread.
+        Nothing may be recorded in the log once it is closed.
+        """
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def checkpoint(self) -> None:
+        """Save a snapshot of the network and empty the log.
+        The events recorded but not written yet are dropped, since the snapshot already holds their mutations.
+        Preconditions:
+            - self.network is not None
+        """
+        with self.network.lock:
+            self.network.save_snapshot(self.snapshot_file, self.csv_file, self.passwords_file)
+            self._reset()
+
+    def _reset(self) -> None:
+        """Empty the log (and drop the events not written yet), starting it from the current snapshot.
+        Preconditions:
+            - self.network is not None
+            - the current snapshot holds every mutation recorded so far
+        """
+        with self.network.lock, self._file_lock:
+            with open(self.path, 'wb') as file:
+                file.write(self._header())
+                file.flush()
+                os.fsync(file.fileno())
+            self._known = all_patients(self.network)
+            with self._condition:
+                self._queue = []
+                self._durable = self._queued
+                self.events = 0
+                self._condition.notify_all()
+
+
+def patient_state(patient: Patient) -> dict[str, Any]:
+    """Return the values needed to create patient again, including its keys.
+    """
+    state = {field: getattr(patient, field) for field in PATIENT_FIELDS}
+    state['keys'] = (tuple(patient.private_key), patient.public_key)
+    return state
+
+
+def all_patients(network: HealthNetwork) -> dict[str, Patient]:
+    """Return a mapping of username to every patient of an office of network or on the waitlist of one.
+    """
+    patients = {}
+    for office in network.offices.values():
+        for patient in office.patients + office.waitlist:
+            patients[patient.username] = patient
+
+    return patients
+
+
+def apply_event(network: HealthNetwork, patients: dict[str, Patient], event: tuple) -> None:
+    """Apply the given logged event to network, where patients maps the username of every patient the events so
+    far have referred to to its Patient object.
+    Preconditions:
+        - network.log is None
+    """
+    kind, args = event[0], event[1:]
+    offices = network.offices
+    doctors = network.doctor_index.doctors
+
+    if kind == 'patient':
+        state = dict(args[0])
+        private_key, public_key = state.pop('keys')
+        state['keys'] = (cp.PrivateKey(*private_key), public_key)
+        patients[state['username']] = Patient(current=None, **state)
+    elif kind == 'waitlist':
+        offices[doctors[args[0]]].waitlist_patient(patients[args[1]])
+    elif kind == 'add':
+        offices[doctors[args[0]]].add_patient(patients[args[1]])
+    elif kind == 'decline':
+        offices[doctors[args[0]]].decline_patient(patients[args[1]])
+    elif kind == 'remove':
+        network.remove_patient(patients[args[0]])
+    elif kind == 'diagnosis':
+        network.set_diagnosis(patients[args[0]], args[1])
+    elif kind == 'move':
+        patient = patients[args[0]]
+        patient.destination = offices[doctors[args[1]]]
+        network.move_patient(patient)
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod(verbose=True)
+
+    import python_ta
+    python_ta.check_all(config={
+        'max-line-length': 120,
+        'extra-imports': ['atexit', 'csv', 'hashlib', 'io', 'json', 'os', 'pickle', 'secrets', 'shelve', 'struct',
+                          'threading', 'time', 'data_security', 'database'],
+        'disable': ['forbidden-IO-function']
+    })